@@ -1,17 +1,336 @@
 #!/usr/bin/python3
 
 import argparse
+import concurrent.futures
+import contextlib
 import datetime
+import hashlib
+import io
+import itertools
 import json
 import logging
+import multiprocessing
 import os
+import re
+import resource
+import signal
+import threading
+import time
 import zipfile
 from pathlib import Path
 
+import numpy as np
+import openpyxl
 import pandas as pd
+from openpyxl.cell.cell import ERROR_CODES
+from pandas.io.parsers import TextParser
 
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+
+try:
+    # Parquet engine for the cache of parsed xlsx files (optional)
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+default_path = Path(__file__).resolve().parent
+# Ways of writing parsed rows to the database: COPY FROM STDIN (bulk)
+# or execute_batch with per-row insert (fallback)
+LOADERS = ('copy', 'batch')
+DEFAULT_CHUNK_SIZE = 100000
+# Ways of finding new and changed rows in convert_scd1_to_scd2
+SCD2_ENGINES = ('hash', 'join')
+# Ways of finding deleted rows in convert_scd1_to_scd2
+DELETION_MODES = ('checksum', 'full')
+DEFAULT_BUCKETS = 1024
+# Engines for fraud types 3 and 4 in build_report: SQL script
+# (sql_scripts/rep_fraud_3_4.sql) or sliding windows in python
+REPORT_ENGINES = ('sql', 'python')
+# Report modes: copy records of previous days to every report
+# or append only new events (cumulative report is view rdkv_v_rep_fraud)
+REPORT_MODES = ('cumulative', 'incremental')
+# Compression methods of the archived datafiles (*.backup.zip)
+ARCHIVE_CODECS = {'deflated': zipfile.ZIP_DEFLATED,
+                  'bzip2': zipfile.ZIP_BZIP2,
+                  'lzma': zipfile.ZIP_LZMA,
+                  'stored': zipfile.ZIP_STORED}
+# Compression levels accepted by the codecs, None - the codec has no level
+ARCHIVE_LEVELS = {'deflated': range(0, 10), 'bzip2': range(1, 10),
+                  'lzma': None, 'stored': None}
+# Ways of converting terminals snapshot to SCD2: the whole snapshot
+# (sql_scripts/terminals_to_scd2.sql) or only the rows changed since the
+# fingerprint of the previous snapshot (terminals_to_scd2_delta.sql)
+TERMINALS_MODES = ('full', 'delta')
+# Source tables for SCD2 replication: (table, primary key, renamed columns)
+SCD1_TABLES = (('accounts', 'account', {'account': 'account_num'}),
+               ('cards', 'card_num', {'account': 'account_num'}),
+               ('clients', 'client_id', None))
+# Columns of transactions_DDMMYYYY.txt in the order of the fact table
+TRANSACTIONS_COLUMNS = ('transaction_id', 'transaction_date', 'amount',
+                        'card_num', 'oper_type', 'oper_result', 'terminal')
+# Engines for enrichment of transactions with dimensions in build_report:
+# SQL range joins (sql_scripts/rep_tmp.sql) or in-memory interval indexes
+ENRICH_ENGINES = ('sql', 'python')
+# Dimensions for enrichment of transactions by the "python" engine:
+# table: (natural key, columns, only not deleted versions are joined)
+ENRICH_DIMENSIONS = {
+    'cards': ('card_num', ('account_num', ), True),
+    'accounts': ('account_num', ('valid_to', 'client', 'deleted_flg'), False),
+    'clients': ('client_id', ('passport_num', 'last_name', 'first_name',
+                              'patronymic', 'phone', 'passport_valid_to'),
+                True)}
+# Poll interval and settle time of the watch mode in seconds
+DEFAULT_POLL_INTERVAL = 10
+DEFAULT_SETTLE_TIME = 30
+# Limit of the interval between retries of a failing run in watch mode
+# (the poll interval is doubled after every failure), seconds
+MAX_RETRY_INTERVAL = 600
+# Key of the PostgreSQL advisory lock held by a loading run (cron or watch)
+RUN_LOCK_ID = 710010
+# Metrics of the run: stages (measure_stage) and SQL statements
+# (execute_sql), they are saved by write_metrics
+run_metrics = {'stages': [], 'statements': []}
+# File for EXPLAIN (ANALYZE, BUFFERS) plans of the statements executed by
+# execute_sql, None - the statements are executed without plans
+explain_path = None
+_metrics_lock = threading.Lock()
+# SCD2 history of ENRICH_DIMENSIONS with interval indexes (see
+# load_dimension), it is kept between the runs of the watch mode
+dimension_cache = dict()
+# Stack of measured stages of the current thread
+_stages = threading.local()
+
+
+def rss_bytes():
+    """Resident memory of the process (the peak value if the current one
+    is not available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextlib.contextmanager
+def measure_stage(name, **labels):
+    """
+    Measure wall time, written rows and peak memory of the stage
+
+    The rows (loaded from files or source, written to the report) are
+    counted by add_rows in the same thread for all the nested stages, the
+    peak memory of the process is sampled in background.
+    labels - additional values for the stage record (e.g. date)
+    """
+    stage = {'stage': name, **labels, 'rows': 0}
+    stack = _stages.__dict__.setdefault('stack', [])
+    stack.append(stage)
+    peak = [rss_bytes()]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(0.05):
+            peak[0] = max(peak[0], rss_bytes())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        yield stage
+    finally:
+        elapsed = time.perf_counter() - start
+        stop.set()
+        sampler.join()
+        stack.remove(stage)
+        stage['seconds'] = round(elapsed, 3)
+        stage['rows_per_sec'] = round(stage['rows'] / elapsed, 1) \
+            if elapsed > 0 else None
+        stage['peak_memory_mb'] = round(max(peak[0], rss_bytes()) / 2 ** 20,
+                                        1)
+        with _metrics_lock:
+            run_metrics['stages'].append(stage)
+
+
+def add_rows(rows):
+    """Add written rows to the measured stages of the current thread"""
+    for stage in getattr(_stages, 'stack', ()):
+        stage['rows'] += rows
+
+
+def split_sql(query):
+    """
+    Split SQL text by ';' outside of quotes and comments
+
+    Return list of tuples (statement, True if it has code and not only
+    comments)
+    """
+    dollar = re.compile(r'\$[A-Za-z_]*\$')
+    result, start, i, code = [], 0, 0, False
+    while i < len(query):
+        c = query[i]
+        if query.startswith('--', i):
+            end = query.find('\n', i)
+            i = len(query) if end < 0 else end + 1
+            continue
+        if query.startswith('/*', i):
+            end = query.find('*/', i + 2)
+            i = len(query) if end < 0 else end + 2
+            continue
+        match = dollar.match(query, i) if c == '$' else None
+        if c in '\'"' or match:
+            quote = c if match is None else match.group()
+            end = query.find(quote, i + len(quote))
+            # Doubled quotes are the escaped ones
+            while match is None and end >= 0 \
+                    and query.startswith(quote, end + 1):
+                end = query.find(quote, end + 2)
+            i = len(query) if end < 0 else end + len(quote)
+            code = True
+            continue
+        if c == ';':
+            result.append((query[start:i], code))
+            start, code = i + 1, False
+        elif not c.isspace():
+            code = True
+        i += 1
+    if start < len(query):
+        result.append((query[start:], code))
+    return result
+
+
+def execute_sql(cursor, query, params=None, name='sql'):
+    """
+    Execute SQL statements of 'query' one by one and record wall time,
+    rows and rows/sec of every statement to run_metrics (with EXPLAIN
+    (ANALYZE, BUFFERS) plan and no rows if explain_path is set)
+
+    params - dictionary of named parameters for all statements or
+        sequence of positional parameters of all statements in order
+    name - name of the statements in metrics (e.g. script file name)
+    Returns amount of rows inserted and updated by the statements (without
+    plans only).
+    """
+    position, total = 0, 0
+    for number, (statement, code) in enumerate(split_sql(query)):
+        args = params
+        if params is not None and not isinstance(params, dict):
+            # Positional parameters of the statement (psycopg2 replaces
+            # them in comments too)
+            count = statement.count('%s')
+            args = tuple(params[position:position + count]) or None
+            position += count
+        if not code:
+            continue
+        words = re.sub(r'--[^\n]*|/\*.*?\*/', ' ', statement,
+                       flags=re.S).split()
+        keyword = words[0].lower()
+        start = time.perf_counter()
+        plan = None
+        if explain_path is not None and keyword in ('select', 'insert',
+                                                    'update', 'delete',
+                                                    'with'):
+            cursor.execute('explain (analyze, buffers)\n' + statement, args)
+            plan = [x[0] for x in cursor.fetchall()]
+            rows = None
+        else:
+            cursor.execute(statement, args)
+            rows = cursor.rowcount if cursor.rowcount >= 0 else None
+        elapsed = time.perf_counter() - start
+        if rows is not None and keyword in ('insert', 'update'):
+            total += rows
+        stack = getattr(_stages, 'stack', None)
+        record = {'name': name, 'statement': number,
+                  'text': ' '.join(words[:6]),
+                  'stage': stack[-1]['stage'] if stack else None,
+                  'seconds': round(elapsed, 3), 'rows': rows,
+                  'rows_per_sec': round(rows / elapsed, 1)
+                  if rows is not None and elapsed > 0 else None}
+        with _metrics_lock:
+            run_metrics['statements'].append(record)
+            if plan is not None:
+                with open(explain_path, 'a') as f:
+                    f.write(f'-- {name} #{number} ({record["stage"]}, '
+                            f'{elapsed:.3f} s)\n{statement.strip()}\n\n')
+                    f.write('\n'.join(plan) + '\n\n')
+    return total
+
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def write_metrics(path: Path, started, success):
+    """
+    Save run_metrics to 'path' dir as json summary of the run
+    (run_YYYYMMDD_HHMMSS.json) and Prometheus textfile rdkv_etl.prom
+    (the stages and statements are summed up by name)
+    """
+    finished = datetime.datetime.now()
+    summary = {'started': started.isoformat(timespec='seconds'),
+               'finished': finished.isoformat(timespec='seconds'),
+               'seconds': round((finished - started).total_seconds(), 3),
+               'success': success,
+               **run_metrics}
+    path.mkdir(parents=True, exist_ok=True)
+    with open(path / f'run_{started:%Y%m%d_%H%M%S}.json', 'w') as f:
+        f.write(json.dumps(summary, indent=4, default=str))
+    stages, statements = dict(), dict()
+    for x in run_metrics['stages']:
+        total = stages.setdefault(x['stage'], [0, 0, 0])
+        total[0] += x['seconds']
+        total[1] += x['rows']
+        total[2] = max(total[2], x['peak_memory_mb'])
+    for x in run_metrics['statements']:
+        total = statements.setdefault((x['name'], x['statement']), [0, 0, 0])
+        total[0] += x['seconds']
+        total[1] += x['rows'] or 0
+        total[2] += 1
+    lines = []
+
+    def add(metric, kind, text, values):
+        lines.extend((f'# HELP rdkv_etl_{metric} {text}',
+                      f'# TYPE rdkv_etl_{metric} {kind}'))
+        for labels, value in values:
+            label = ','.join(f'{k}="{prometheus_label(v)}"'
+                             for k, v in labels.items())
+            lines.append(f'rdkv_etl_{metric}{{{label}}} {value}' if label
+                         else f'rdkv_etl_{metric} {value}')
+
+    add('run_success', 'gauge', 'Result of the last run (1 - success)',
+        [({}, int(success))])
+    add('run_timestamp_seconds', 'gauge', 'Finish time of the last run',
+        [({}, round(finished.timestamp()))])
+    add('run_seconds', 'gauge', 'Wall time of the last run',
+        [({}, summary['seconds'])])
+    add('stage_seconds', 'gauge', 'Wall time of the stage',
+        [({'stage': k}, round(v[0], 3)) for k, v in stages.items()])
+    add('stage_rows', 'gauge', 'Rows loaded by the stage',
+        [({'stage': k}, v[1]) for k, v in stages.items()])
+    add('stage_rows_per_second', 'gauge', 'Throughput of the stage',
+        [({'stage': k}, round(v[1] / v[0], 1) if v[0] else 0)
+         for k, v in stages.items()])
+    add('stage_peak_memory_bytes', 'gauge', 'Peak resident memory',
+        [({'stage': k}, int(v[2] * 2 ** 20)) for k, v in stages.items()])
+    add('statement_seconds', 'gauge', 'Wall time of the SQL statement',
+        [({'name': k[0], 'statement': k[1]}, round(v[0], 3))
+         for k, v in statements.items()])
+    add('statement_rows', 'gauge', 'Rows of the SQL statement',
+        [({'name': k[0], 'statement': k[1]}, v[1])
+         for k, v in statements.items()])
+    add('statement_rows_per_second', 'gauge',
+        'Throughput of the SQL statement',
+        [({'name': k[0], 'statement': k[1]}, round(v[1] / v[0], 1)
+          if v[0] else 0) for k, v in statements.items()])
+    add('statement_calls', 'gauge', 'Executions of the SQL statement',
+        [({'name': k[0], 'statement': k[1]}, v[2])
+         for k, v in statements.items()])
+    # Replace the textfile at once for the node exporter
+    tmp_path = path / 'rdkv_etl.prom.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path / 'rdkv_etl.prom')
 
 
 def ddl_init(ddl_path: Path, conn):
@@ -44,51 +363,398 @@ def get_update_dt_from_meta(schema_name, table_name, conn):
         return cursor.fetchone()[0]
 
 
-def load_transactions_file(path: Path, conn):
-    logging.info(f'Start loading rows from "{path}"')
-    # Load transactions from file and parse timestamp and numeric values
-    df = pd.read_csv(path, sep=';', decimal=',',
-                     parse_dates=['transaction_date'],
-                     date_parser=lambda x:
-                     datetime.datetime.strptime(x, '%Y-%m-%d %H:%M:%S'))
-    query = '''
-    insert into de10.rdkv_dwh_fact_tracnsactions
-    (trans_id, trans_date, amt, card_num, oper_type, oper_result, terminal)
-    values(%s, %s, %s, %s, %s, %s, %s)
-    '''
-    # Load transactions to the database
-    with conn.cursor() as cursor:
+def write_rows(cursor, table, columns, df, method='copy',
+               chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Write DataFrame rows to the table in target database
+
+    table - full table name with schema (str)
+    columns - target columns in the same order as columns of df
+    method - 'copy' (COPY FROM STDIN by chunks of chunk_size rows)
+        or 'batch' (execute_batch with insert for every row)
+    """
+    if method == 'batch':
+        query = (f'insert into {table}({", ".join(columns)}) '
+                 f'values({", ".join("%s" for _ in columns)})')
         psycopg2.extras.execute_batch(cursor, query, df.values.tolist())
-    logging.info(f'End loading rows from "{path}". Loaded {df.shape[0]} rows')
+        return
+    query = (f'copy {table}({", ".join(columns)}) '
+             'from stdin with (format csv)')
+    for start in range(0, df.shape[0], chunk_size):
+        # Serialize the chunk to csv in memory and stream it to the server
+        buf = io.StringIO()
+        df.iloc[start:start + chunk_size].to_csv(buf, header=False,
+                                                 index=False)
+        buf.seek(0)
+        cursor.copy_expert(query, buf)
+
+
+def read_transactions_file(path: Path, chunk_size=DEFAULT_CHUNK_SIZE,
+                           data=None):
+    """
+    Parse transactions file by chunks of chunk_size rows
+
+    Yields tuples (DataFrame with parsed rows, amount of bad rows in chunk).
+    Rows with wrong amount of fields, without transaction_id or with
+    unparsable transaction_date/amount are counted as bad and skipped.
+    data - content of the file if it is already read
+    """
+    with open(path) if data is None \
+            else io.TextIOWrapper(io.BytesIO(data)) as f:
+        header = f.readline().rstrip('\r\n').split(';')
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if len(lines) == 0:
+                break
+            # Skip empty lines and lines with wrong amount of fields
+            lines = [x for x in lines if x.strip() != '']
+            good = [x for x in lines if x.count(';') == len(header) - 1]
+            bad = len(lines) - len(good)
+            if len(good) == 0:
+                # Empty chunk with the types of the parsed columns
+                yield pd.DataFrame(columns=TRANSACTIONS_COLUMNS, dtype=str) \
+                    .astype({'transaction_date': 'datetime64[ns]',
+                             'amount': float}), bad
+                continue
+            df = pd.read_csv(io.StringIO(''.join(good)), sep=';',
+                             header=None, names=header, dtype=str)
+            df = df[list(TRANSACTIONS_COLUMNS)]
+            # Parse timestamp and numeric values for the whole chunk
+            df['transaction_date'] = pd.to_datetime(df.transaction_date,
+                                                    format='%Y-%m-%d %H:%M:%S',
+                                                    errors='coerce')
+            df['amount'] = pd.to_numeric(
+                df.amount.str.replace(',', '.', regex=False), errors='coerce')
+            is_valid = df.transaction_id.notna() \
+                & df.transaction_date.notna() & df.amount.notna()
+            bad += int((~is_valid).sum())
+            yield df[is_valid], bad
+
+
+def create_transactions_partitions(dates, conn):
+    """Create daily partitions of the transactions table if necessary"""
+    with conn.cursor() as cursor:
+        for date in sorted(dates):
+            name = f'rdkv_dwh_fact_tracnsactions_{date.strftime("%Y%m%d")}'
+            cursor.execute(f'''create table if not exists de10.{name}
+                partition of de10.rdkv_dwh_fact_tracnsactions
+                for values from (%s) to (%s)''',
+                           (date, date + datetime.timedelta(days=1)))
+
 
+def load_transactions_file(path: Path, conn, method='copy',
+                           chunk_size=DEFAULT_CHUNK_SIZE, chunks=None):
+    """
+    Load transactions file to the fact table
 
-def load_passport_blacklist_file(path: Path, key: str, conn):
+    chunks - already parsed chunks of the file (see read_transactions_file),
+        if it is None the file is parsed here chunk by chunk
+    """
     logging.info(f'Start loading rows from "{path}"')
+    columns = ('trans_id', 'trans_date', 'amt', 'card_num', 'oper_type',
+               'oper_result', 'terminal')
+    if chunks is None:
+        chunks = read_transactions_file(path, chunk_size)
+    rows, skipped = 0, 0
+    partitions = set()
+    # Parse transactions by chunks and load every chunk to the database
+    with conn.cursor() as cursor:
+        for df, bad in chunks:
+            skipped += bad
+            if df.shape[0] == 0:
+                continue
+            dates = set(df.transaction_date.dt.date.unique())
+            create_transactions_partitions(dates - partitions, conn)
+            partitions |= dates
+            write_rows(cursor, 'de10.rdkv_dwh_fact_tracnsactions', columns,
+                       df, method, chunk_size)
+            rows += df.shape[0]
+        # Collect statistics of the loaded partitions for the report queries
+        for date in sorted(partitions):
+            cursor.execute('analyze de10.rdkv_dwh_fact_tracnsactions_'
+                           f'{date.strftime("%Y%m%d")}')
+    add_rows(rows)
+    if skipped != 0:
+        logging.warning(f'File "{path}" has {skipped} bad rows, '
+                        'they are skipped')
+    logging.info(f'End loading rows from "{path}". Loaded {rows} rows' +
+                 (f', skipped {skipped} bad rows' if skipped != 0 else ''))
+
+
+def xlsx_value(value):
+    """Convert cell value like the openpyxl reader of pd.read_excel"""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value in ERROR_CODES:
+        return np.nan
+    return value
+
+
+def read_xlsx_file(path: Path, data=None):
+    """Parse the first sheet of xlsx file (or its content 'data') into the
+    same DataFrame as pd.read_excel, the cell values are streamed from the
+    read-only workbook without building the cell objects"""
+    book = openpyxl.load_workbook(path if data is None else io.BytesIO(data),
+                                  read_only=True, data_only=True,
+                                  keep_links=False)
+    try:
+        sheet = book.worksheets[0]
+        sheet.reset_dimensions()
+        data, last = [], -1
+        for i, row in enumerate(sheet.iter_rows(values_only=True)):
+            row = [xlsx_value(x) for x in row]
+            while row and row[-1] == '':
+                row.pop()
+            if row:
+                last = i
+            data.append(row)
+    finally:
+        book.close()
+    # Trim trailing empty rows and extend rows to the same width
+    data = data[:last + 1]
+    if len(data) == 0:
+        return pd.DataFrame()
+    width = max(len(x) for x in data)
+    data = [x + [''] * (width - len(x)) for x in data]
+    return TextParser(data, header=0).read()
+
+
+def read_cached_xlsx_file(path: Path, cache_dir: Path = None, data=None):
+    """
+    Parse xlsx file by read_xlsx_file or take it from the cache
+
+    cache_dir - directory with parsed files in parquet format named by
+        sha256 of the xlsx file content, so the same file is parsed once
+        in re-runs and backfills (no cache if None or without pyarrow)
+    data - content of the file if it is already read
+    """
+    if cache_dir is None or pyarrow is None:
+        return read_xlsx_file(path, data)
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    cache_path = Path(cache_dir) / f'{digest}.parquet'
+    if cache_path.is_file():
+        return pd.read_parquet(cache_path)
+    df = read_xlsx_file(path, data)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Write under a temporary name for concurrent workers
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return df
+
+
+def read_passport_blacklist_file(path: Path, key: str, cache_dir=None,
+                                 data=None):
+    """Parse passport blacklist file, return rows for 'key' date and
+    amount of the skipped rows"""
     date = datetime.datetime.strptime(key, '%Y-%m-%d')
-    df = pd.read_excel(path)
+    df = read_cached_xlsx_file(path, cache_dir, data)
     shape = df.shape[0]
     # Filter rows per date and calculate amount of the skipped rows
     df = df[df.date == date]
-    skipped = shape - df.shape[0]
+    return df, shape - df.shape[0]
+
+
+def load_passport_blacklist_file(path: Path, key: str, conn, method='copy',
+                                 chunk_size=DEFAULT_CHUNK_SIZE, parsed=None,
+                                 cache_dir=None):
+    logging.info(f'Start loading rows from "{path}"')
+    df, skipped = read_passport_blacklist_file(path, key, cache_dir) \
+        if parsed is None else parsed
     # Load the list of passports in the database
-    query = ('insert into de10.rdkv_dwh_fact_passport_blacklist'
-             '(entry_dt, passport_num) values(%s, %s)')
     with conn.cursor() as cursor:
-        psycopg2.extras.execute_batch(cursor, query, df.values.tolist())
+        write_rows(cursor, 'de10.rdkv_dwh_fact_passport_blacklist',
+                   ('entry_dt', 'passport_num'), df, method, chunk_size)
+    add_rows(df.shape[0])
     logging.info(f'End loading rows from "{path}". Loaded {df.shape[0]} rows' +
                  (f', skipped {skipped} rows ("date" <> {key})'
                   if skipped != 0 else ''))
 
 
-def load_terminals_file(path: Path, conn):
+def read_terminals_file(path: Path, cache_dir=None, data=None):
+    return read_cached_xlsx_file(path, cache_dir, data)
+
+
+def load_terminals_file(path: Path, conn, method='copy',
+                        chunk_size=DEFAULT_CHUNK_SIZE, df=None,
+                        cache_dir=None):
     logging.info(f'Start loading rows from "{path}"')
-    df = pd.read_excel(path)
-    query = ('insert into de10.rdkv_stg_terminals'
-             '(terminal_id, terminal_type, terminal_city, terminal_address) '
-             'values(%s, %s, %s, %s)')
+    if df is None:
+        df = read_terminals_file(path, cache_dir)
+    columns = ('terminal_id', 'terminal_type', 'terminal_city',
+               'terminal_address')
     with conn.cursor() as cursor:
         cursor.execute('delete from de10.rdkv_stg_terminals')
-        psycopg2.extras.execute_batch(cursor, query, df.values.tolist())
+        write_rows(cursor, 'de10.rdkv_stg_terminals', columns, df, method,
+                   chunk_size)
+    add_rows(df.shape[0])
+
+
+def terminals_fingerprint(df):
+    """Hashes of terminals rows by terminal_id, the values are compared as
+    they are written to the database (empty values are NULL)"""
+    fingerprint = dict()
+    for row in df.itertuples(index=False, name=None):
+        text = '\t'.join('\\N' if pd.isna(x) or x == '' else copy_value(x)
+                         for x in row)
+        fingerprint[str(row[0])] = hashlib.md5(text.encode()).hexdigest()
+    return fingerprint
+
+
+def read_terminals_fingerprint(cache_dir: Path, key: str, conn):
+    """
+    Fingerprint of the previous terminals snapshot from the cache
+    directory or None if it can not be used for 'key' date: its date
+    differs from the last loaded date in meta (the hist table was changed
+    without it) or 'key' is not after it
+    """
+    path = Path(cache_dir) / 'terminals_fingerprint.json'
+    if not path.is_file():
+        return None
+    with open(path) as f:
+        fingerprint = json.loads(f.read())
+    update_dt = get_update_dt_from_meta('de10', 'rdkv_stg_terminals', conn)
+    if fingerprint['date'] != update_dt or key <= update_dt:
+        return None
+    return fingerprint['rows']
+
+
+def write_terminals_fingerprint(cache_dir: Path, key: str, fingerprint):
+    path = Path(cache_dir) / 'terminals_fingerprint.json'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps({'date': key, 'rows': fingerprint}))
+    os.replace(tmp_path, path)
+
+
+def load_terminals_delta(df, deleted, conn, method='copy',
+                         chunk_size=DEFAULT_CHUNK_SIZE):
+    """Write new and changed terminals (df) and ids of the deleted ones
+    to the staging tables for sql_scripts/terminals_to_scd2_delta.sql"""
+    columns = ('terminal_id', 'terminal_type', 'terminal_city',
+               'terminal_address')
+    with conn.cursor() as cursor:
+        cursor.execute('delete from de10.rdkv_stg_terminals')
+        write_rows(cursor, 'de10.rdkv_stg_terminals', columns, df, method,
+                   chunk_size)
+        cursor.execute('delete from de10.rdkv_stg_terminals_del')
+        copy_rows(cursor, 'de10.rdkv_stg_terminals_del', ('terminal_id', ),
+                  ((x, ) for x in deleted))
+    logging.info(f'Terminals delta: {df.shape[0]} new or changed rows, '
+                 f'{len(deleted)} deleted rows')
+
+
+def terminals_to_scd2(path: Path, key: str, conn, method='copy',
+                      chunk_size=DEFAULT_CHUNK_SIZE, df=None, cache_dir=None,
+                      mode='full'):
+    """
+    Load terminals file for 'key' date and convert it to SCD2 with commit
+
+    mode - 'full' (the whole snapshot is loaded and compared in the
+        database) or 'delta' (the snapshot is compared with the fingerprint
+        of the previous one in 'cache_dir' and only the changes are loaded,
+        falls back to 'full' if there is no valid fingerprint)
+    """
+    scripts = default_path / 'sql_scripts'
+    if mode == 'delta' and cache_dir is not None:
+        if df is None:
+            df = read_terminals_file(path, cache_dir)
+        current = terminals_fingerprint(df)
+        previous = read_terminals_fingerprint(cache_dir, key, conn)
+        # Duplicated ids are compared by the full rows in the full mode
+        if len(current) != df.shape[0] or df.iloc[:, 0].isna().any():
+            previous = None
+        if previous is None:
+            logging.info('There is no fingerprint of the previous terminals '
+                         'snapshot, the full snapshot is converted to SCD2')
+            load_terminals_file(path, conn, method, chunk_size, df)
+            convert_terminals_to_scd2(scripts / 'terminals_to_scd2.sql',
+                                      key, conn)
+        else:
+            changed = [previous.get(x) != h for x, h in current.items()]
+            add_rows(df.shape[0])
+            load_terminals_delta(df[changed], previous.keys() - current.keys(),
+                                 conn, method, chunk_size)
+            convert_terminals_to_scd2(
+                scripts / 'terminals_to_scd2_delta.sql', key, conn)
+        # The fingerprint is written after commit of the snapshot
+        write_terminals_fingerprint(cache_dir, key, current)
+        return
+    load_terminals_file(path, conn, method, chunk_size, df, cache_dir)
+    convert_terminals_to_scd2(scripts / 'terminals_to_scd2.sql', key, conn)
+
+
+def parse_day_files(in_path: Path, files: dict, key: str,
+                    chunk_size=DEFAULT_CHUNK_SIZE, cache_dir=None,
+                    capture=False, captured=None):
+    """
+    Parse and validate the full set of datafiles for 'key' date
+
+    Runs in a worker process of the pipeline, so the whole parsed
+    content of the files is returned instead of a generator
+    files - dictionary (prefix: filename)
+    capture - read every file once and return its content for the
+        archive stage too (key 'captured', dictionary filename: bytes)
+    captured - content of the files which are already read (e.g. from
+        the archives), the files are not read from 'in_path' then
+    """
+    if captured is None:
+        captured = {f: (in_path / f).read_bytes() for f in files.values()} \
+            if capture else dict()
+    return {
+        'transactions': list(read_transactions_file(
+            in_path / files['transactions'], chunk_size,
+            captured.get(files['transactions']))),
+        'passport_blacklist': read_passport_blacklist_file(
+            in_path / files['passport_blacklist'], key, cache_dir,
+            captured.get(files['passport_blacklist'])),
+        'terminals': read_terminals_file(
+            in_path / files['terminals'], cache_dir,
+            captured.get(files['terminals'])),
+        'captured': captured}
+
+
+def load_day_files(in_path: Path, out_path: Path, files: dict, key: str,
+                   conn, method='copy', chunk_size=DEFAULT_CHUNK_SIZE,
+                   parsed=None, cache_dir=None, terminals_mode='full',
+                   capture=False, archive=None):
+    """
+    Load the full set of datafiles for 'key' date in one transaction,
+    convert terminals to SCD2 and move the files to the backup directory
+
+    files - dictionary (prefix: filename)
+    parsed - result of parse_day_files, the files are parsed here if None
+    cache_dir - directory of the parsed xlsx files cache and the terminals
+        fingerprint
+    terminals_mode - 'full' or 'delta' conversion of terminals to SCD2
+    capture - read the files once for parsing and archiving (in memory)
+    archive - dictionary of backup_files options (codec, level, jobs)
+    """
+    if parsed is None:
+        parsed = parse_day_files(in_path, files, key, chunk_size, cache_dir,
+                                 True) if capture else dict()
+    with measure_stage('transactions', date=key):
+        load_transactions_file(in_path / files['transactions'], conn, method,
+                               chunk_size, parsed.get('transactions'))
+    with measure_stage('passport_blacklist', date=key):
+        load_passport_blacklist_file(in_path / files['passport_blacklist'],
+                                     key, conn, method, chunk_size,
+                                     parsed.get('passport_blacklist'),
+                                     cache_dir)
+    with measure_stage('terminals', date=key):
+        terminals_to_scd2(in_path / files['terminals'], key, conn, method,
+                          chunk_size, parsed.get('terminals'), cache_dir,
+                          terminals_mode)
+    logging.info(f'Files for {key} are successfully loaded')
+    with measure_stage('archive', date=key):
+        backup_files(in_path, out_path, list(files.values()),
+                     captured=parsed.get('captured'), **(archive or dict()))
 
 
 def replicate_inline_value(value, query):
@@ -97,17 +763,198 @@ def replicate_inline_value(value, query):
     return tuple(value for _ in range(cnt))
 
 
-def convert_terminals_to_scd2(path: Path, dt, conn):
+def convert_terminals_to_scd2(path: Path, dt, conn, commit=True):
     with conn.cursor() as cursor, open(path) as f:
         # Convert loaded terminals data to SCD2 format
         query = f.read()
-        cursor.execute(query, replicate_inline_value(dt, query))
-    conn.commit()
+        execute_sql(cursor, query, replicate_inline_value(dt, query),
+                    path.name)
+    if commit:
+        conn.commit()
+
+
+def copy_value(value):
+    """Convert python value to the text format of COPY command"""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_text(values):
+    """Convert strings (None for NULL) to the text format of COPY command,
+    the strings are escaped only if some of them have special characters"""
+    text = ''.join(filter(None, values))
+    if any(x in text for x in '\\\t\n\r'):
+        return [copy_value(x) for x in values]
+    return ['\\N' if x is None else x for x in values]
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Write rows (list of tuples) to the table with COPY FROM STDIN"""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(copy_value(x) for x in row))
+        buf.write('\n')
+    buf.seek(0)
+    cursor.copy_expert(f'copy {table}({", ".join(columns)}) from stdin', buf)
+
+
+def stream_query(query, params, conn, batch_size=DEFAULT_CHUNK_SIZE):
+    """Execute query in a server-side cursor and yield rows by batches"""
+    with conn.cursor(name='rdkv_stream', withhold=True) as cursor:
+        cursor.itersize = batch_size
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            yield rows
+
+
+def copy_frame(query, params, columns, conn, integers=()):
+    """
+    Fetch rows of the query with COPY TO STDOUT as DataFrame of strings
+    (None for NULL), the values are parsed by read_csv, which is much
+    faster than fetchall for large results
+
+    columns - names of the query columns
+    integers - names of the columns without NULL converted to int64
+    """
+    buf = io.StringIO()
+    with conn.cursor() as cursor:
+        if params is not None:
+            query = cursor.mogrify(query, params).decode()
+        cursor.copy_expert(f"copy ({query}) to stdout "
+                           "with (format csv, null '\\N')", buf)
+    if buf.tell() == 0:
+        # read_csv fails on the empty result
+        df = pd.DataFrame(columns=columns, dtype=object)
+    else:
+        buf.seek(0)
+        df = pd.read_csv(buf, header=None, names=columns, dtype=object,
+                         na_values=['\\N'], keep_default_na=False)
+    for x in df.columns:
+        if x in integers:
+            df[x] = df[x].astype(np.int64)
+        elif df[x].isna().any():
+            df[x] = df[x].where(df[x].notna(), None)
+    return df
+
+
+def row_hash_sql(columns, alias=None):
+    """SQL expression with md5 hash of the row content"""
+    prefix = '' if alias is None else f'{alias}.'
+    return f'md5(row({", ".join(prefix + x for x in columns)})::text)'
+
+
+def bucket_sql(id, buckets):
+    """SQL expression with number of the bucket for primary key"""
+    return (f"mod(('x' || substr(md5({id}), 17, 8))::bit(32)::int "
+            f"& 2147483647, {buckets})")
+
+
+def key_checksums(query, conn):
+    """Fetch checksums per bucket as dictionary (bucket: (count, sum))"""
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+        return {x[0]: (x[1], x[2]) for x in cursor.fetchall()}
+
+
+def load_changed_buckets_to_del(table, id_target, id_source, conn_source,
+                                conn_target, schema_source='info',
+                                schema_target='de10', buckets=DEFAULT_BUCKETS,
+                                batch_size=DEFAULT_CHUNK_SIZE):
+    """
+    Find buckets of primary keys which differ in source and in actual
+    rows of hist and load source keys only for these buckets to stg
+
+    Every key is put into one of 'buckets' groups by its md5 hash, the
+    checksum of group is amount of keys and sum of 64 bit key hashes.
+    Keys of hist are taken once, so keys with a new version which is not
+    closed yet do not change the checksum.
+    Returns list of differing buckets.
+    id_source - SQL expression of the primary key in source
+    """
+    query = '''select {bucket}, count(*),
+        sum(('x' || substr(md5({id}), 1, 16))::bit(64)::bigint)
+        from {table} {where} group by 1'''
+    source = key_checksums(query.format(
+        bucket=bucket_sql(id_source, buckets), id=id_source,
+        table=f'{schema_source}.{table}', where=''), conn_source)
+    target = key_checksums(query.format(
+        bucket=bucket_sql(id_target, buckets), id=id_target,
+        table=f'''(select distinct {id_target}
+            from {schema_target}.rdkv_dwh_dim_{table}_hist
+            where deleted_flg = 'N'
+                and effective_to = to_timestamp('9999-12-31', 'YYYY-MM-DD')
+            ) t''', where=''), conn_target)
+    changed = sorted(x for x in set(source) | set(target)
+                     if x is not None and source.get(x) != target.get(x))
+    stg_del = f'{schema_target}.rdkv_stg_{table}_del'
+    with conn_target.cursor() as cursor:
+        cursor.execute(f'delete from {stg_del}')
+        if len(changed) > 0:
+            query = f'''select {id_source} from {schema_source}.{table}
+                where {bucket_sql(id_source, buckets)} = any(%s)'''
+            for rows in stream_query(query, (changed, ), conn_source,
+                                     batch_size):
+                copy_rows(cursor, stg_del, (id_target, ), rows)
+    logging.info(f'Checksums of {table} primary keys differ for '
+                 f'{len(changed)} of {buckets} buckets')
+    return changed
+
+
+def load_scd1_to_stg_hashed(table, id_target, columns_target, query_stg,
+                            query_del, update_db, conn_source, conn_target,
+                            schema_target='de10',
+                            batch_size=DEFAULT_CHUNK_SIZE):
+    """
+    Stream new rows and primary keys from source to stg tables with COPY
+    and insert new or changed rows to hist comparing (id, row_hash)
+
+    query_del - query for primary keys, if it is None the keys are not loaded
+    """
+    stg = f'{schema_target}.rdkv_stg_{table}'
+    hist = f'{schema_target}.rdkv_dwh_dim_{table}_hist'
+    params = None
+    if update_db is not None:
+        # add incremental condition if it necessary
+        query_stg = f'{query_stg} where coalesce(update_dt, create_dt)> %s'
+        params = (update_db, )
+    with conn_target.cursor() as cursor:
+        # Clean stg tables in target and load new data by batches
+        cursor.execute(f'delete from {stg}')
+        for rows in stream_query(query_stg, params, conn_source, batch_size):
+            copy_rows(cursor, stg, (*columns_target, 'start_dt'), rows)
+            add_rows(len(rows))
+        if query_del is not None:
+            cursor.execute(f'delete from {stg}_del')
+            for rows in stream_query(query_del, None, conn_source,
+                                     batch_size):
+                copy_rows(cursor, f'{stg}_del', (id_target, ), rows)
+        # Insert data to hist (new or updated rows)
+        query = f'''insert into {hist}
+            ({", ".join(columns_target)}, effective_from, row_hash)
+            select {', '.join('s.' + x for x in columns_target)}, s.start_dt,
+                {row_hash_sql(columns_target, 's')}
+            from {stg} s
+            where not exists (
+                select 1 from {hist} t
+                where t.{id_target} = s.{id_target}
+                    and t.row_hash = {row_hash_sql(columns_target, 's')}
+                    and t.effective_to
+                        = to_timestamp('9999-12-31', 'YYYY-MM-DD')
+                    and t.deleted_flg = 'N')
+            '''
+        execute_sql(cursor, query, name=f'{table}_hist_insert')
 
 
 def convert_scd1_to_scd2(table, id, renamed_columns, conn_source,
                          conn_target, now, schema_source='info',
-                         schema_target='de10'):
+                         schema_target='de10', engine='hash',
+                         batch_size=DEFAULT_CHUNK_SIZE, deletion='full',
+                         buckets=DEFAULT_BUCKETS):
     """
     Converting datatable from SCD1 to SCD2 format for two different datasources
 
@@ -118,6 +965,12 @@ def convert_scd1_to_scd2(table, id, renamed_columns, conn_source,
         value - colum name in target,
     conn_source, conn_target - connection object for source (target) database,
     schema_source, schema_target - schema for source (target) database
+    engine - 'hash' (stream source rows by batches of batch_size rows and
+        find new and changed rows by (id, row_hash)) or 'join' (fetch all
+        the rows and compare every column with hist)
+    deletion - 'checksum' (compare checksums of 'buckets' groups of primary
+        keys in source and target and load keys only for the differing
+        groups) or 'full' (load all the primary keys from source every run)
     """
     def trim_sql(names):
         """Add trim command to sql substring for character columns"""
@@ -170,6 +1023,26 @@ def convert_scd1_to_scd2(table, id, renamed_columns, conn_source,
     effective_to timestamp(0) default to_timestamp('9999-12-31', 'YYYY-MM-DD'),
     deleted_flg char(1) default 'N' );
 
+    alter table {schema_target}.rdkv_dwh_dim_{table}_hist
+        add column if not exists row_hash char(32);
+
+    -- Hash of the rows loaded before the column was added (once, then the
+    -- partial index is empty and the update does not scan the table)
+    create index if not exists rdkv_dwh_dim_{table}_hist_nohash_idx
+        on {schema_target}.rdkv_dwh_dim_{table}_hist ({id_target})
+        where row_hash is null;
+
+    update {schema_target}.rdkv_dwh_dim_{table}_hist
+    set row_hash = {row_hash_sql(columns_target)}
+    where row_hash is null;
+
+    create index if not exists rdkv_dwh_dim_{table}_hist_hash_idx
+        on {schema_target}.rdkv_dwh_dim_{table}_hist ({id_target}, row_hash);
+
+    create index if not exists rdkv_dwh_dim_{table}_hist_idx
+        on {schema_target}.rdkv_dwh_dim_{table}_hist
+        ({id_target}, effective_to);
+
     create table if not exists {schema_target}.rdkv_stg_{table}_del (
         {id_target} {columns[id]} );
 
@@ -190,48 +1063,72 @@ def convert_scd1_to_scd2(table, id, renamed_columns, conn_source,
     query_stg = f'''select {", ".join(trim_sql(columns_source))},
         coalesce(update_dt, create_dt) start_dt
         from {schema_source}.{table}'''
-    with conn_source.cursor() as cursor:
-        # add incremental condition if it necessary
-        if update_db is None:
-            cursor.execute(query_stg)
-        else:
-            query_stg = f'{query_stg} where coalesce(update_dt, create_dt)> %s'
-        cursor.execute(query_stg, (update_db, ))
-        rows_stg = cursor.fetchall()
-        # Load pk table from source to check deleted items
-        cursor.execute(f'''select {trim_sql([id])[0]}
-                       from {schema_source}.{table}''')
-        rows_stg_del = cursor.fetchall()
+    query_del = None
+    if deletion == 'full':
+        query_del = f'''select {trim_sql([id])[0]}
+                       from {schema_source}.{table}'''
+    if engine == 'hash':
+        load_scd1_to_stg_hashed(table, id_target, columns_target, query_stg,
+                                query_del, update_db, conn_source,
+                                conn_target, schema_target, batch_size)
+    else:
+        with conn_source.cursor() as cursor:
+            # add incremental condition if it necessary
+            if update_db is None:
+                cursor.execute(query_stg)
+            else:
+                query_stg = (f'{query_stg} '
+                             'where coalesce(update_dt, create_dt)> %s')
+            cursor.execute(query_stg, (update_db, ))
+            rows_stg = cursor.fetchall()
+            add_rows(len(rows_stg))
+            # Load pk table from source to check deleted items
+            if query_del is not None:
+                cursor.execute(query_del)
+                rows_stg_del = cursor.fetchall()
+        with conn_target.cursor() as cursor:
+            # Clean stg table in target and load new data
+            cursor.execute(f'delete from {schema_target}.rdkv_stg_{table}')
+            query = f'''insert into {schema_target}.rdkv_stg_{table}
+              ({", ".join(columns_target)}, start_dt )
+              values({', '.join('%s' for _ in columns_target)}, %s)'''
+            psycopg2.extras.execute_batch(cursor, query, rows_stg)
+            if query_del is not None:
+                cursor.execute(
+                    f'delete from {schema_target}.rdkv_stg_{table}_del')
+                query = f'''insert into {schema_target}.rdkv_stg_{table}_del
+                        ({id_target}) values(%s)'''
+                psycopg2.extras.execute_batch(cursor, query, rows_stg_del)
+            # Constract join condition for loading to hist
+            join_condition = ' and '.join(
+                f'''((s.{x} = t.{x}) or (s.{x} is null
+                and t.{x} is null))''' for x in columns_target)
+            # Insert data to hist (new or updated rows)
+            query = f'''insert into {schema_target}.rdkv_dwh_dim_{table}_hist
+                ({", ".join(columns_target)}, effective_from, row_hash)
+                select {', '.join('s.' + x for x in columns_target)},
+                    s.start_dt, {row_hash_sql(columns_target, 's')}
+                from {schema_target}.rdkv_stg_{table} s
+                left join {schema_target}.rdkv_dwh_dim_{table}_hist t
+                    on {join_condition}
+                    and t.effective_to
+                        = to_timestamp('9999-12-31', 'YYYY-MM-DD')
+                    and t.deleted_flg = 'N'
+                where t.{id_target} is null
+                '''
+            execute_sql(cursor, query, name=f'{table}_hist_insert')
+    changed_buckets = None
+    if deletion == 'checksum':
+        # Load to stg only primary keys from buckets which differ
+        changed_buckets = load_changed_buckets_to_del(
+            table, id_target, trim_sql([id])[0], conn_source, conn_target,
+            schema_source, schema_target, buckets, batch_size)
     with conn_target.cursor() as cursor:
-        # Clean stg table in target and load new data
-        cursor.execute(f'delete from {schema_target}.rdkv_stg_{table}')
-        query = f'''insert into {schema_target}.rdkv_stg_{table}
-          ({", ".join(columns_target)}, start_dt )
-          values({', '.join('%s' for _ in range(len(columns_target) + 1))})'''
-        psycopg2.extras.execute_batch(cursor, query, rows_stg)
-        cursor.execute(f'delete from {schema_target}.rdkv_stg_{table}_del')
-        query = f'''insert into {schema_target}.rdkv_stg_{table}_del
-                ({id_target}) values(%s)'''
-        psycopg2.extras.execute_batch(cursor, query, rows_stg_del)
-        # Constract join condition for loading to hist
-        join_condition = ' and '.join(f'''((s.{x} = t.{x}) or (s.{x} is null
-            and t.{x} is null))''' for x in columns_target)
-        # Insert data to hist (new or updated rows)
-        query = f'''insert into {schema_target}.rdkv_dwh_dim_{table}_hist
-            ({", ".join(columns_target)}, effective_from)
-            select {', '.join('s.' + x for x in columns_target)}, s.start_dt
-            from {schema_target}.rdkv_stg_{table} s
-            left join {schema_target}.rdkv_dwh_dim_{table}_hist t
-                on {join_condition}
-                and t.effective_to = to_timestamp('9999-12-31', 'YYYY-MM-DD')
-                and t.deleted_flg = 'N'
-            where t.{id_target} is null
-            '''
-        cursor.execute(query)
         # Insert data to hist (deleted rows in source)
         query = f'''insert into {schema_target}.rdkv_dwh_dim_{table}_hist(
-            {", ".join(columns_target)}, effective_from, deleted_flg)
-            select {", ".join("t." + x for x in columns_target)}, %s, 'Y'
+            {", ".join(columns_target)}, effective_from, deleted_flg, row_hash)
+            select {", ".join("t." + x for x in columns_target)}, %s, 'Y',
+                t.row_hash
             from {schema_target}.rdkv_dwh_dim_{table}_hist t
             left join {schema_target}.rdkv_stg_{table}_del d
                 on t.{id_target} = d.{id_target}
@@ -239,8 +1136,14 @@ def convert_scd1_to_scd2(table, id, renamed_columns, conn_source,
             and t.deleted_flg = 'N' and
             t.effective_to = to_timestamp('9999-12-31', 'YYYY-MM-DD')
             '''
+        if changed_buckets is None:
+            execute_sql(cursor, query, (now, ), f'{table}_hist_delete')
+        elif len(changed_buckets) > 0:
+            query += f'''and {bucket_sql('t.' + id_target, buckets)}
+                = any(%s)'''
+            execute_sql(cursor, query, (now, changed_buckets),
+                        f'{table}_hist_delete')
         # fix efficient_to attribute for updated rows in hist and update meta
-        cursor.execute(query, (now, ))
         query = f'''update {schema_target}.rdkv_dwh_dim_{table}_hist
         set effective_to = t.effective_from - interval '1 second'
         from {schema_target}.rdkv_dwh_dim_{table}_hist t
@@ -257,70 +1160,649 @@ def convert_scd1_to_scd2(table, id, renamed_columns, conn_source,
         where schema_name='{schema_source}' and table_name='{table}'))
         where schema_name='{schema_source}' and table_name='{table}';
         '''
-        cursor.execute(query)
+        execute_sql(cursor, query, name=f'{table}_hist_close')
         # fix transacrion
         conn_target.commit()
         logging.info((f'Loading from {schema_source}.{table} '
                      'to DWH is completed'))
 
 
-def backup_files(in_path: Path, out_path: Path, files: list):
-    """Compress and move 'files' from 'in_path' dir to 'out_path'"""
+def open_scd1_pools(tables, db_conf, pool_size=1):
+    """Open pools of connections to source and target databases for
+    replicate_scd1_tables (at most one connection per table)"""
+    pool_size = max(1, min(pool_size, len(tables)))
+    pool_source = psycopg2.pool.ThreadedConnectionPool(1, pool_size,
+                                                       **db_conf['source'])
+    pool_target = psycopg2.pool.ThreadedConnectionPool(1, pool_size,
+                                                       **db_conf['target'])
+    logging.info(f'Connection pools with {pool_size} connections to "source" '
+                 'and "target" databases are successfully opened')
+    return pool_source, pool_target
+
+
+def replicate_scd1_tables(tables, db_conf, now, pool_size=1, pools=None,
+                          **options):
+    """
+    Convert source tables to SCD2 format in parallel
+
+    Every table is loaded in a separate thread with its own pair of
+    connections from the pools of source and target databases.
+    tables - list of tuples (table, id, renamed_columns),
+    db_conf - dictionary with 'source' and 'target' connection parameters,
+    pools - pools of source and target connections (see open_scd1_pools)
+        kept open by the caller between runs, if None the pools are opened
+        and closed here
+    options - keyword arguments for convert_scd1_to_scd2
+    """
+    if pools is None:
+        pool_source, pool_target = open_scd1_pools(tables, db_conf,
+                                                   pool_size)
+    else:
+        pool_source, pool_target = pools
+    pool_size = pool_target.maxconn
+
+    def replicate(table, id, renamed_columns):
+        conn_source = pool_source.getconn()
+        conn_target = pool_target.getconn()
+        try:
+            conn_source.autocommit = True
+            conn_target.autocommit = False
+            with measure_stage(f'scd2:{table}') as stage:
+                convert_scd1_to_scd2(table, id, renamed_columns, conn_source,
+                                     conn_target, now, **options)
+            return stage['rows']
+        except Exception:
+            # Leave neither hist rows nor meta update of the failed table
+            conn_target.rollback()
+            raise
+        finally:
+            pool_source.putconn(conn_source)
+            pool_target.putconn(conn_target)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(pool_size) as executor:
+            futures = {x[0]: executor.submit(replicate, *x) for x in tables}
+        failed = []
+        for table, future in futures.items():
+            try:
+                # Rows of the table threads for the stage of the caller
+                add_rows(future.result())
+            except Exception:
+                schema = options.get('schema_source', 'info')
+                logging.error(f'Loading from {schema}.{table} to DWH is '
+                              'failed', exc_info=True)
+                failed.append(table)
+    finally:
+        if pools is None:
+            pool_source.closeall()
+            pool_target.closeall()
+    if len(failed) > 0:
+        raise Exception(f'Loading to DWH is failed for {", ".join(failed)}')
+
+
+def fsync_dir(path: Path):
+    """Flush directory entries (renamed and created files) to disk"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def archive_file(in_path: Path, out_path: Path, name: str, codec='deflated',
+                 level=9, data=None):
+    """
+    Compress file 'name' from 'in_path' dir to 'name'.backup.zip in
+    'out_path' dir, the archive is flushed to disk before the return
+
+    level - compression level (see ARCHIVE_LEVELS), None for the codecs
+        without levels
+    data - captured content of the file, the file is streamed from disk
+        if it is None
+    The temporary archive is removed if compression fails.
+    Return sha256 of the file content
+    """
+    p_from = in_path / name
+    p_to = out_path / f'{name}.backup.zip'
+    p_tmp = out_path / f'{name}.backup.zip.tmp'
+    digest = hashlib.sha256()
+    try:
+        with open(p_tmp, 'wb') as f:
+            with zipfile.ZipFile(f, 'w', ARCHIVE_CODECS[codec],
+                                 compresslevel=level) as zip_file:
+                if data is not None:
+                    digest.update(data)
+                    zip_file.writestr(zipfile.ZipInfo.from_file(p_from, name),
+                                      data, ARCHIVE_CODECS[codec], level)
+                else:
+                    zip_file.write(p_from, name)
+                    with open(p_from, 'rb') as src:
+                        for block in iter(lambda: src.read(1 << 20), b''):
+                            digest.update(block)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(p_tmp, p_to)
+    except BaseException:
+        p_tmp.unlink(missing_ok=True)
+        raise
+    return digest.hexdigest()
+
+
+def backup_files(in_path: Path, out_path: Path, files: list,
+                 codec='deflated', level=9, jobs=1, captured=None):
+    """
+    Compress and move 'files' from 'in_path' dir to 'out_path'
+
+    The files are compressed in a pool of 'jobs' threads with 'codec'
+    (see ARCHIVE_CODECS) and 'level', sha256 of every file is appended to
+    'out_path'/manifest.sha256 and the originals are removed only after
+    the archives and the manifest are flushed to disk
+    captured - dictionary (filename: content) of the files already read
+        during loading
+    """
+    if captured is None:
+        captured = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        digests = list(executor.map(
+            lambda f: archive_file(in_path, out_path, f, codec, level,
+                                   captured.get(f)), files))
+    with open(out_path / 'manifest.sha256', 'a') as manifest:
+        for f, digest in zip(files, digests):
+            manifest.write(f'{digest}  {f}\n')
+        manifest.flush()
+        os.fsync(manifest.fileno())
+    fsync_dir(out_path)
     for f in files:
-        p_from: Path = in_path / f
-        p_to = out_path / f'{f}.backup.zip'
-        with zipfile.ZipFile(p_to, 'w',
-                             compression=zipfile.ZIP_DEFLATED,
-                             compresslevel=9) as zip_file:
-            zip_file.write(p_from, f)
-        p_from.unlink()
+        (in_path / f).unlink()
 
 
-def build_report(script: Path, conn):
-    with conn.cursor() as cursor, open(script) as f:
-        # Load report script from file (sql_scripts/rep.sql)
-        query = f.read()
+def find_fraud_3_4(df, date):
+    """
+    Find transactions of 'date' with fraud types 3 and 4 by sliding
+    windows per card
+
+    df - transactions from 'date' minus one hour to the end of 'date'
+        sorted by card_num and trans_date with columns card_num,
+        trans_date, trans_id, amt, oper_result, terminal_city
+    Returns list of tuples (trans_id, event_type)
+    """
+    if df.shape[0] == 0:
+        return []
+    start = np.datetime64(date, 's').astype(np.int64)
+    card = df.card_num.values
+    # Number of card in the sorted rows and time in seconds from the first
+    # second of the window, key orders rows by card and time
+    code = np.concatenate(([0], np.cumsum(card[1:] != card[:-1])))
+    time = df.trans_date.values.astype('datetime64[s]').astype(np.int64)
+    time -= start - 3600
+    key = code * (1 << 32) + time
+    amt = df.amt.astype(float).values
+    success = (df.oper_result == 'SUCCESS').values
+    city = pd.factorize(df.terminal_city)[0]
+    # Successful transactions of the date are checked for fraud
+    target = np.flatnonzero(success & (time >= 3600))
+    hits = []
+    # 3rd type: successful transactions in different cities within an hour,
+    # the window has two cities if the latest transaction with a city other
+    # than the city of the last transaction in the window is inside it
+    eligible = np.flatnonzero(success & (city >= 0))
+    if len(eligible) > 0:
+        e_code, e_time = code[eligible], time[eligible]
+        e_city = city[eligible]
+        # Index of the previous transaction with other card or city
+        is_start = np.concatenate(([True], (e_code[1:] != e_code[:-1])
+                                   | (e_city[1:] != e_city[:-1])))
+        prev_other = np.maximum.accumulate(
+            np.where(is_start, np.arange(len(eligible)), 0)) - 1
+        last = np.searchsorted(key[eligible], key[target], 'right') - 1
+        other = prev_other[np.maximum(last, 0)]
+        is_hit = (last >= 0) & (other >= 0)
+        is_hit &= e_code[np.maximum(other, 0)] == code[target]
+        is_hit &= e_time[np.maximum(other, 0)] >= time[target] - 3600
+        hits.extend((x, 3) for x in df.trans_id.values[target[is_hit]])
+    # 4th type: at least three operations within 20 minutes before the
+    # transaction, the last three are unsuccessful with decreasing amounts
+    # and greater than the amount of the transaction
+    last = np.searchsorted(key, key[target] - 1, 'right') - 1
+    first = np.searchsorted(key, key[target] - 1200, 'left')
+    cnt = last - first + 1
+    is_hit = cnt >= 3
+    c, b, a, prev = (np.maximum(last - i, 0) for i in range(4))
+    is_hit &= ~(success[a] | success[b] | success[c])
+    is_hit &= (amt[a] > amt[b]) & (amt[b] > amt[c])
+    is_hit &= (cnt == 3) | (amt[prev] > amt[a])
+    is_hit &= amt[c] > amt[target]
+    hits.extend((x, 4) for x in df.trans_id.values[target[is_hit]])
+    return hits
+
+
+def detect_fraud_3_4(date, conn, batch_size=DEFAULT_CHUNK_SIZE):
+    """
+    Find transactions of 'date' with fraud types 3 and 4 in one streaming
+    pass over the transactions sorted by card
+
+    Returns list of tuples (trans_id, event_type)
+    """
+    columns = ('card_num', 'trans_date', 'trans_id', 'amt', 'oper_result',
+               'terminal_city')
+    query = '''select tr.card_num, tr.trans_date, tr.trans_id, tr.amt,
+        tr.oper_result, term.terminal_city
+    from de10.rdkv_dwh_fact_tracnsactions tr
+    left join lateral (
+        select terminal_city from de10.rdkv_dwh_dim_terminals_hist term
+        where term.terminal_id = tr.terminal and term.deleted_flg = 'N'
+            and term.effective_to >= tr.trans_date
+            and term.effective_from <= tr.trans_date
+        limit 1) term on true
+    where tr.trans_date >= cast(%s as timestamp) - interval '1 hour'
+        and tr.trans_date < cast(%s as timestamp) + interval '1 day'
+        and tr.card_num is not null
+    order by tr.card_num, tr.trans_date, tr.trans_id'''
+    hits, rows = [], []
+    for batch in stream_query(query, (date, date), conn, batch_size):
+        rows.extend(batch)
+        # Check all the cards except the last one, which can continue
+        # in the next batch
+        i = len(rows) - 1
+        while i > 0 and rows[i - 1][0] == rows[-1][0]:
+            i -= 1
+        if i > 0:
+            df = pd.DataFrame.from_records(rows[:i], columns=columns)
+            hits.extend(find_fraud_3_4(df, date))
+            rows = rows[i:]
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    hits.extend(find_fraud_3_4(df, date))
+    return hits
+
+
+def load_dimension(table, conn):
+    """
+    Load SCD2 history of the dimension to dimension_cache or refresh it
+
+    Only versions of the keys which have new versions since the cached
+    watermark (max effective_from) are fetched. The whole history is
+    fetched again if the cache is empty (also if the hist table was empty
+    and there is no watermark) or the amount of the versions before the
+    watermark has changed (e.g. a version with older effective_from is
+    added). The cached amount and watermark are replaced only together
+    with the merged versions.
+    Return the cache entry: dictionary with the versions (DataFrame
+    sorted by key and effective_from, see dimension_index) and the
+    watermark.
+    """
+    key, columns, active = ENRICH_DIMENSIONS[table]
+    hist = f'de10.rdkv_dwh_dim_{table}_hist'
+    # Bounds are fetched as seconds since the epoch and the columns as
+    # text, they are written back by COPY without parsing
+    query = f'''select {key},
+            cast(extract(epoch from effective_from) as bigint),
+            cast(extract(epoch from effective_to) as bigint),
+            {", ".join(f"cast({x} as text)" for x in columns)}
+        from {hist}
+        where {key} is not null and effective_from is not null
+            and effective_to is not null
+            {"and deleted_flg = 'N'" if active else ''}'''
+    bounds = ('effective_from', 'effective_to')
+    names = (key, *bounds, *columns)
+    entry = dimension_cache.get(table)
+    if entry is not None and (entry['watermark'] is None
+                              or entry['count'] == 0):
+        entry = None
+    with conn.cursor() as cursor:
+        cursor.execute(f'''select count(*) filter (where effective_from <= %s),
+                count(*), max(effective_from)
+            from {hist}''', (None if entry is None else entry['watermark'], ))
+        before, count, watermark = cursor.fetchone()
+    if entry is not None and before == entry['count']:
+        if count == entry['count']:
+            return entry
+        # Versions of the changed keys (deleted versions too)
+        changed = copy_frame(f'''{query} and {key} in (
+            select {key} from {hist} where effective_from > %s)''',
+                             (entry['watermark'], ), names, conn, bounds)
+        versions = entry['versions']
+        versions = pd.concat([versions[~versions[key].isin(changed[key])],
+                              changed], ignore_index=True)
+    else:
+        versions = copy_frame(query, None, names, conn, bounds)
+    versions, index = dimension_index(versions, key)
+    entry = {'versions': versions, 'count': count, 'watermark': watermark,
+             'index': index}
+    dimension_cache[table] = entry
+    logging.info(f'Dimension {table} is cached: {versions.shape[0]} '
+                 f'versions of {versions[key].nunique()} keys')
+    return entry
+
+
+def dimension_index(versions, key):
+    """
+    Sort the versions by key and effective_from and build their interval
+    index: dictionary of unique keys, codes of keys and bounds of the
+    versions (seconds since the epoch)
+
+    Returns tuple (sorted versions, index), the index is None if the
+    versions of one key overlap, so one transaction can match several
+    versions and the index can not be used.
+    """
+    codes, keys = pd.factorize(versions[key], sort=True)
+    order = np.lexsort((versions['effective_from'].to_numpy(), codes))
+    versions = versions.take(order).reset_index(drop=True)
+    codes = codes[order].astype(np.int64)
+    bounds = {x: versions[x].to_numpy(dtype=np.int64)
+              for x in ('effective_from', 'effective_to')}
+    same = codes[1:] == codes[:-1]
+    if (same & (bounds['effective_to'][:-1]
+                >= bounds['effective_from'][1:])).any():
+        return versions, None
+    return versions, {'keys': keys, 'codes': codes, **bounds}
+
+
+def find_versions(index, keys, times):
+    """
+    Positions of the versions valid at 'times' (seconds since the epoch)
+    for 'keys' in the sorted versions of the index, -1 if there is no
+    version
+
+    Versions are found by one binary search in the composite array of
+    (code of key, effective_from) for all transactions.
+    """
+    if len(index['codes']) == 0:
+        return np.full(len(times), -1)
+    codes = index['keys'].get_indexer(keys).astype(np.int64)
+    start = min(index['effective_from'].min(initial=0), times.min(initial=0))
+    span = max(index['effective_from'].max(initial=0),
+               times.max(initial=0)) - start + 1
+    composite = index['codes'] * span + (index['effective_from'] - start)
+    pos = np.searchsorted(composite, codes * span + (times - start),
+                          side='right') - 1
+    found = (codes >= 0) & (pos >= 0)
+    pos = np.where(found, pos, 0)
+    found &= (index['codes'][pos] == codes) \
+        & (index['effective_to'][pos] >= times)
+    return np.where(found, pos, -1)
+
+
+def enrich_transactions(dates, conn):
+    """
+    Fill de10.rdkv_stg_rep_fraud_tmp with successful transactions of
+    'dates' and their cards, accounts and clients as of the transaction
+    time like rep_tmp.sql (rep_batch_tmp.sql) does with the range joins
+
+    The dimensions are resolved in the cached interval indexes (see
+    load_dimension) and the flat rows are written with COPY.
+    Returns False without changes if the index of a dimension can not be
+    used (overlapping versions), then the SQL script should be used.
+    """
+    entries = {x: load_dimension(x, conn) for x in ENRICH_DIMENSIONS}
+    if any(x['index'] is None for x in entries.values()):
+        logging.warning('Dimensions have overlapping versions, the '
+                        'transactions are enriched by SQL')
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute('''select trans_id, card_num,
+                cast(extract(epoch from trans_date) as bigint),
+                cast(trans_date as text),
+                cast(cast(trans_date as date) as text)
+            from de10.rdkv_dwh_fact_tracnsactions
+            where trans_date >= cast(%s as timestamp)
+                and trans_date < cast(%s as timestamp) + interval '1 day'
+                and cast(trans_date as date) = any(%s)
+                and oper_result = 'SUCCESS' ''',
+                       (min(dates), max(dates), list(dates)))
+        trans = pd.DataFrame(cursor.fetchall(),
+                             columns=('trans_id', 'card_num', 'epoch',
+                                      'event_dt', 'load_dt'))
+    times = trans['epoch'].to_numpy(dtype=np.int64)
+    found = np.ones(len(times), dtype=bool)
+    # Resolve card -> account -> client as of the transaction time
+    keys = trans['card_num'].to_numpy()
+    pos = dict()
+    for table, link in (('cards', 'account_num'), ('accounts', 'client'),
+                        ('clients', None)):
+        pos[table] = find_versions(entries[table]['index'], keys, times)
+        found &= pos[table] >= 0
+        # Nothing is found in an empty dimension, its links are not taken
+        if link is not None and found.any():
+            keys = entries[table]['versions'][link].to_numpy() \
+                .take(np.where(found, pos[table], 0))
+    idx = np.flatnonzero(found)
+
+    def take(table, column):
+        return entries[table]['versions'][column].to_numpy() \
+            .take(pos[table][idx])
+
+    names = [pd.Series(take('clients', x)).fillna('')
+             for x in ('last_name', 'first_name', 'patronymic')]
+    fio = (names[0] + ' ' + names[1] + ' ' + names[2]).str.rstrip(' ')
+    columns = {
+        'trans_id': trans['trans_id'].to_numpy().take(idx),
+        'event_dt': trans['event_dt'].to_numpy().take(idx),
+        'passport': take('clients', 'passport_num'),
+        'fio': fio,
+        'phone': take('clients', 'phone'),
+        'passport_valid_to': take('clients', 'passport_valid_to'),
+        'acc_valid_to': take('accounts', 'valid_to'),
+        'acc_deleted_flg': take('accounts', 'deleted_flg'),
+        'load_dt': trans['load_dt'].to_numpy().take(idx)}
+    # All the values are text, so the rows are joined without formatting
+    buf = io.StringIO(''.join(f'{x}\n' for x in map('\t'.join, zip(
+        *(copy_text(x) for x in columns.values())))))
+    with conn.cursor() as cursor:
+        cursor.execute('delete from de10.rdkv_stg_rep_fraud_tmp')
+        cursor.copy_expert('copy de10.rdkv_stg_rep_fraud_tmp('
+                           f'{", ".join(columns)}) from stdin', buf)
+    add_rows(len(idx))
+    return True
+
+
+def build_date_report(script: Path, date, conn, engine='sql',
+                      batch_size=DEFAULT_CHUNK_SIZE, mode='cumulative',
+                      enrich='sql'):
+    """
+    Build report for 'date' without commit
+
+    script - main report script (sql_scripts/rep.sql), the scripts for
+        previous days, enrichment and fraud types 3 and 4 are taken from
+        the same directory
+    engine - 'sql' or 'python' for fraud types 3 and 4
+    mode - 'cumulative' (copy records of previous days with the report
+        date) or 'incremental' (add only events of the date)
+    enrich - 'sql' (sql_scripts/rep_tmp.sql) or 'python' (function
+        enrich_transactions) for enrichment of transactions
+    """
+    with conn.cursor() as cursor:
+        if mode == 'cumulative':
+            with open(script.parent / 'rep_prev_days.sql') as f:
+                query = f.read()
+            add_rows(execute_sql(cursor, query,
+                                 replicate_inline_value(date, query),
+                                 'rep_prev_days.sql'))
+        if enrich == 'sql' or not enrich_transactions((date, ), conn):
+            with open(script.parent / 'rep_tmp.sql') as f:
+                query = f.read()
+            add_rows(execute_sql(cursor, query,
+                                 replicate_inline_value(date, query),
+                                 'rep_tmp.sql'))
+        with open(script) as f:
+            query = f.read()
+        add_rows(execute_sql(cursor, query,
+                             replicate_inline_value(date, query),
+                             script.name))
+        if engine == 'sql':
+            with open(script.parent / 'rep_fraud_3_4.sql') as f:
+                query = f.read()
+            add_rows(execute_sql(cursor, query,
+                                 replicate_inline_value(date, query),
+                                 'rep_fraud_3_4.sql'))
+            return
+        insert_fraud_3_4_hits((date, ), conn, batch_size)
+
+
+def insert_fraud_3_4_hits(dates, conn, batch_size=DEFAULT_CHUNK_SIZE):
+    """Add fraud types 3 and 4 found by the "python" engine for 'dates'
+    to the report (de10.rdkv_stg_rep_fraud_tmp is filled for the dates)"""
+    with conn.cursor() as cursor:
+        cursor.execute('delete from de10.rdkv_stg_rep_fraud_hits')
+        for date in dates:
+            hits = detect_fraud_3_4(date, conn, batch_size)
+            copy_rows(cursor, 'de10.rdkv_stg_rep_fraud_hits',
+                      ('trans_id', 'event_type', 'load_dt'),
+                      ((*x, date) for x in hits))
+        add_rows(execute_sql(cursor, '''
+        insert into de10.rdkv_rep_fraud
+        (event_dt, passport, fio, phone, event_type, report_dt)
+        select tmp.event_dt, tmp.passport, tmp.fio, tmp.phone, h.event_type,
+            tmp.load_dt
+        from de10.rdkv_stg_rep_fraud_tmp tmp
+        inner join de10.rdkv_stg_rep_fraud_hits h
+            on tmp.trans_id = h.trans_id and tmp.load_dt = h.load_dt
+        ''', name='rep_fraud_hits'))
+
+
+def build_batch_report(script: Path, dates, conn, engine='sql',
+                       batch_size=DEFAULT_CHUNK_SIZE, mode='cumulative',
+                       enrich='sql'):
+    """
+    Build report for all 'dates' of the queue in one set-based pass
+    without commit
+
+    script - main report script (sql_scripts/rep.sql), the batch scripts
+        (rep_batch*.sql) are taken from the same directory
+    dates - sorted dates of the queue de10.rdkv_stg_rep_fraud_loads
+    """
+    params = {'first_dt': dates[0], 'last_dt': dates[-1]}
+    scripts = ['rep_batch.sql']
+    if enrich == 'sql' or not enrich_transactions(dates, conn):
+        scripts.insert(0, 'rep_batch_tmp.sql')
+    if engine == 'sql':
+        scripts.append('rep_batch_fraud_3_4.sql')
+    with conn.cursor() as cursor:
+        for name in scripts:
+            with open(script.parent / name) as f:
+                add_rows(execute_sql(cursor, f.read(), params, name))
+        if engine != 'sql':
+            insert_fraud_3_4_hits(dates, conn, batch_size)
+        # Previous days are copied after all types of fraud are added,
+        # so the later dates get the records of the earlier ones
+        if mode == 'cumulative':
+            with open(script.parent / 'rep_batch_prev_days.sql') as f:
+                add_rows(execute_sql(cursor, f.read(),
+                                     name='rep_batch_prev_days.sql'))
+        cursor.execute('''
+        insert into de10.rdkv_rep_fraud_dates(report_dt)
+        select distinct l.load_dt from de10.rdkv_stg_rep_fraud_loads l
+        where not exists (select * from de10.rdkv_rep_fraud_dates d
+            where d.report_dt = l.load_dt)
+        ''')
+        cursor.execute('delete from de10.rdkv_stg_rep_fraud_loads '
+                       'where load_dt = any(%s)', (list(dates), ))
+
+
+def build_report(script: Path, conn, engine='sql',
+                 batch_size=DEFAULT_CHUNK_SIZE, mode='cumulative',
+                 batched=False, enrich='sql'):
+    """
+    Build report for all dates of the queue
+
+    batched - build all dates in one set-based pass with one commit
+        instead of the loop with a commit per date
+    enrich - 'sql' or 'python' engine for enrichment of transactions
+    """
+    with conn.cursor() as cursor:
         # Fetch list of dates for report building
         cursor.execute('select load_dt from de10.rdkv_stg_rep_fraud_loads')
         dates = tuple(sorted(x[0] for x in cursor.fetchall()))
-        # Iterate for dates and build report for every date
-        for date in dates:
-            params = replicate_inline_value(date, query)
-            cursor.execute(query, params)
-            conn.commit()
-            logging.info(f'Report for {date.strftime("%Y-%m-%d")} is created')
+    if batched and dates:
+        dates = tuple(sorted(set(dates)))
+        build_batch_report(script, dates, conn, engine, batch_size, mode,
+                           enrich)
+        conn.commit()
+        logging.info('Report for '
+                     f'{", ".join(x.strftime("%Y-%m-%d") for x in dates)} '
+                     'is created')
+        return
+    # Iterate for dates and build report for every date
+    for date in dates:
+        build_date_report(script, date, conn, engine, batch_size, mode,
+                          enrich)
+        conn.commit()
+        logging.info(f'Report for {date.strftime("%Y-%m-%d")} is created')
+
+
+def compact_report(script: Path, conn):
+    """Remove records of previous days from the report (migration to
+    the 'incremental' mode, script sql_scripts/rep_compact.sql)"""
+    with conn.cursor() as cursor, open(script) as f:
+        execute_sql(cursor, f.read(), name=script.name)
+        # Under EXPLAIN the row count is the lines of the plan
+        if explain_path is None:
+            logging.info(f'{cursor.rowcount} records of previous days are '
+                         'removed from the report')
+        else:
+            logging.info('Records of previous days are removed from the '
+                         'report (EXPLAIN mode, see the plans for rows)')
+    conn.commit()
+
+
+# Datafiles prefixes and suffixes, the names are PREFIX_DDMMYYYY.SUFFIX
+DATAFILES = {'transactions': '.txt', 'passport_blacklist': '.xlsx',
+             'terminals': '.xlsx'}
+
 
+def datafile_date(filename: str):
+    """Prefix and date (YYYY-MM-DD) of the datafile name or None if the
+    name does not match DATAFILES"""
+    for prefix, suffix in DATAFILES.items():
+        if not filename.startswith(prefix + '_') \
+                or not filename.endswith(suffix):
+            continue
+        dt = filename[len(prefix) + 1:-len(suffix)]
+        if len(dt) != 8 or not dt.isdigit():
+            continue
+        dt = f'{dt[-4:]}-{dt[2:4]}-{dt[:2]}'
+        try:
+            datetime.datetime.strptime(dt, '%Y-%m-%d')
+        except ValueError:
+            continue
+        return prefix, dt
+    return None
 
-def load_datafiles(in_path: Path, out_path: Path, conn_edu):
-    prefixes = ('transactions', 'passport_blacklist', 'terminals')
+
+def load_datafiles(in_path: Path, out_path: Path, conn_edu, method='copy',
+                   chunk_size=DEFAULT_CHUNK_SIZE, jobs=1, cache_dir=None,
+                   terminals_mode='full', capture=False, archive=None,
+                   settle=0):
+    """
+    Load full sets of datafiles from 'in_path' per day in date order
+
+    jobs - amount of worker processes for parsing files, if it is more
+        than 1 the files for the next days are parsed in the pool while
+        the current day is written to the database
+    cache_dir - directory of the parsed xlsx files cache and the terminals
+        fingerprint (no cache if None)
+    terminals_mode - 'full' or 'delta' conversion of terminals to SCD2
+    capture - read every file once for parsing and archiving
+    archive - dictionary of backup_files options (codec, level, jobs)
+    settle - files modified less than 'settle' seconds ago are still being
+        written and are not loaded
+    """
+    prefixes = tuple(DATAFILES)
     # dictionary for storing correct files
     dic = {key: dict() for key in prefixes}
+    settled = time.time() - settle
     # Iterate for all files in in_path directory
     for filename in sorted(os.listdir(in_path)):
-        is_wrong_file = True
-        for prefix in prefixes:
-            # Check prefix and suffix in file and its type
-            if filename.startswith(prefix) \
-                and ((prefix == 'transactions'
-                      and filename.endswith('.txt')) or
-                     (prefix != 'transactions'
-                      and filename.endswith('.xlsx'))) \
-                    and Path(in_path / filename).is_file():
-                # extract middle part from filename
-                dt = filename[len(prefix) + 1: -4
-                              if prefix == 'transactions' else -5]
-                if len(dt) == 8 and dt.isdigit():
-                    dt = f'{dt[-4:]}-{dt[2:4]}-{dt[:2]}'
-                    # try to cast middle part as date
-                    try:
-                        datetime.datetime.strptime(dt, '%Y-%m-%d')
-                    except Exception:
-                        pass
-                    else:
-                        dic[prefix][dt] = filename
-                        is_wrong_file = False
-                        break
-        if is_wrong_file:
+        if settle > 0 and (in_path / filename).is_file() \
+                and (in_path / filename).stat().st_mtime > settled:
+            logging.info(f'File "{filename}" is being written and will be '
+                         'loaded later')
+            continue
+        # Check prefix, date and suffix in file and its type
+        found = datafile_date(filename)
+        if found is not None and (in_path / filename).is_file():
+            prefix, dt = found
+            dic[prefix][dt] = filename
+        else:
             logging.info((f'File "{filename}" has wrong filename '
                           'pattern and will not be loaded'))
     # create list of dates for all types of datafiles with right names
@@ -368,23 +1850,410 @@ def load_datafiles(in_path: Path, out_path: Path, conn_edu):
         logging.warning(msg)
         loaded_keys = []
     # Loading data ftom files to target database per day
-    for key in loaded_keys:
-        load_transactions_file(in_path / dic['transactions'][key], conn_edu)
-        path = in_path / dic['passport_blacklist'][key]
-        load_passport_blacklist_file(path, key, conn_edu)
-        load_terminals_file(in_path / dic['terminals'][key], conn_edu)
-        path = default_path / 'sql_scripts' / 'terminals_to_scd2.sql'
-        convert_terminals_to_scd2(path, key, conn_edu)
-        logging.info(f'Files for {key} are successfully loaded')
-        backup_files(in_path, out_path, [dic[pref][key] for pref in prefixes])
+    files = {key: {pref: dic[pref][key] for pref in prefixes}
+             for key in loaded_keys}
+    if jobs <= 1:
+        for key in loaded_keys:
+            load_day_files(in_path, out_path, files[key], key, conn_edu,
+                           method, chunk_size, cache_dir=cache_dir,
+                           terminals_mode=terminals_mode, capture=capture,
+                           archive=archive)
+        return
+    # Workers are spawned, forked ones would inherit the connections and
+    # the threads of the parent
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = dict()
+        try:
+            for i, key in enumerate(loaded_keys):
+                # Parse next days in the pool while the current day is loaded
+                for k in loaded_keys[i:i + jobs + 1]:
+                    if k not in futures:
+                        futures[k] = executor.submit(
+                            parse_day_files, in_path, files[k], k, chunk_size,
+                            cache_dir, capture)
+                parsed = futures.pop(key).result()
+                load_day_files(in_path, out_path, files[key], key, conn_edu,
+                               method, chunk_size, parsed, cache_dir,
+                               terminals_mode, archive=archive)
+        except Exception:
+            for future in futures.values():
+                future.cancel()
+            raise
+
+
+@contextlib.contextmanager
+def run_lock(conn, wait=True):
+    """
+    Hold the advisory lock of the loading run, so runs of the cron and the
+    watch modes do not load the same files at the same time
+
+    wait - wait for the lock, otherwise yield False if it is held by
+        another run
+    """
+    with conn.cursor() as cursor:
+        cursor.execute('select pg_advisory_lock(%s)' if wait else
+                       'select pg_try_advisory_lock(%s)', (RUN_LOCK_ID, ))
+        locked = wait or cursor.fetchone()[0]
+    conn.commit()
+    try:
+        yield locked
+    finally:
+        if locked:
+            conn.rollback()
+            with conn.cursor() as cursor:
+                cursor.execute('select pg_advisory_unlock(%s)',
+                               (RUN_LOCK_ID, ))
+            conn.commit()
+
+
+def run_etl(in_path: Path, out_path: Path, conn_edu, db_conf, args,
+            cache_dir=None, pools=None, settle=0):
+    """
+    Replicate source tables to SCD2, load datafiles and build report for
+    the loaded dates
+
+    args - parsed command line arguments with the loading options
+    pools - connection pools for replicate_scd1_tables
+    settle - see load_datafiles
+    """
+    with conn_edu.cursor() as cursor:
+        # Fix now variable
+        cursor.execute('select cast(now() as timestamp(0))')
+        now = cursor.fetchone()[0]
+    # Grab data from source and converting to SCD2 format in target
+    with measure_stage('scd2'):
+        replicate_scd1_tables(SCD1_TABLES, db_conf, now,
+                              db_conf.get('pool_size', 1), pools,
+                              engine=args.scd2_engine,
+                              batch_size=args.chunk_size,
+                              deletion=args.deletion, buckets=args.buckets)
+    # datafiles processing
+    with measure_stage('datafiles'):
+        load_datafiles(in_path, out_path, conn_edu, args.loader,
+                       args.chunk_size, args.jobs, cache_dir,
+                       args.terminals_mode, args.archive_capture,
+                       {'codec': args.archive_codec,
+                        'level': args.archive_level,
+                        'jobs': args.archive_jobs}, settle)
+    # report processing
+    with measure_stage('report'):
+        build_report(default_path / 'sql_scripts' / 'rep.sql', conn_edu,
+                     args.report_engine, args.chunk_size, args.report_mode,
+                     args.report_batch, args.enrich_engine)
+
+
+def datafiles_snapshot(in_path: Path, settle=0):
+    """Names and modification times of the settled files (see
+    load_datafiles) of the input directory which make full sets of
+    datafiles per day"""
+    settled = time.time() - settle
+    days = dict()
+    for x in os.scandir(in_path):
+        try:
+            mtime = x.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if not x.is_file() or mtime > settled:
+            continue
+        found = datafile_date(x.name)
+        if found is not None:
+            prefix, dt = found
+            days.setdefault(dt, dict())[prefix] = (x.name, mtime)
+    return frozenset(f for x in days.values() if len(x) == len(DATAFILES)
+                     for f in x.values())
+
+
+def watch_datafiles(in_path: Path, out_path: Path, db_conf, args,
+                    cache_dir=None, metrics_dir=None):
+    """
+    Watch the input directory and run run_etl as soon as its settled
+    files change (e.g. the last file of a day is written) until SIGTERM
+    or SIGINT
+
+    Connections to the databases are kept open between the runs and
+    reopened after an error, the loaded dates are taken from the same
+    meta table as in the cron mode. A failing run is retried after the
+    poll interval doubled after every failure (up to MAX_RETRY_INTERVAL).
+    metrics_dir - directory for metrics of every run (see write_metrics)
+    """
+    stop = threading.Event()
+
+    def shutdown(signum, frame):
+        logging.info(f'Signal {signal.Signals(signum).name} is received, '
+                     'stop watching after the current run')
+        stop.set()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, shutdown)
+    logging.info(f'Start watching "{in_path}" every {args.poll_interval} s')
+    conn_edu, pools, processed = None, None, None
+    failures = 0
+    try:
+        while not stop.is_set():
+            snapshot = datafiles_snapshot(in_path, args.settle_time)
+            if snapshot and snapshot != processed:
+                started, success = datetime.datetime.now(), False
+                try:
+                    if conn_edu is None or conn_edu.closed:
+                        conn_edu = psycopg2.connect(**db_conf['target'])
+                        with measure_stage('ddl_init'):
+                            ddl_init(default_path / 'main.ddl', conn_edu)
+                    if pools is None:
+                        pools = open_scd1_pools(SCD1_TABLES, db_conf,
+                                                db_conf.get('pool_size', 1))
+                    with run_lock(conn_edu, wait=False) as locked:
+                        if locked:
+                            run_etl(in_path, out_path, conn_edu, db_conf,
+                                    args, cache_dir, pools,
+                                    args.settle_time)
+                            success = True
+                        else:
+                            logging.info('Another run is loading files, '
+                                         'wait for the next poll')
+                except Exception:
+                    logging.error('Exception occurred', exc_info=True)
+                    failures += 1
+                    # Reconnect before the next run
+                    if conn_edu is not None:
+                        conn_edu.close()
+                    if pools is not None:
+                        for pool in pools:
+                            pool.closeall()
+                        pools = None
+                if success:
+                    # The files left in the directory are not loaded until
+                    # they are changed or new files are added
+                    processed = datafiles_snapshot(in_path,
+                                                   args.settle_time)
+                    failures = 0
+                if metrics_dir is not None and run_metrics['stages']:
+                    write_metrics(metrics_dir, started, success)
+                # Records of the run are not kept by the long-lived process
+                for x in run_metrics.values():
+                    x.clear()
+            interval = args.poll_interval
+            if failures > 0:
+                interval = min(args.poll_interval * 2 ** failures,
+                               max(MAX_RETRY_INTERVAL, args.poll_interval))
+                logging.info(f'Run failed {failures} times in a row, '
+                             f'retry in {interval} s')
+            stop.wait(interval)
+    finally:
+        if conn_edu is not None:
+            conn_edu.close()
+        if pools is not None:
+            for pool in pools:
+                pool.closeall()
+    logging.info('Stop watching')
+
+
+def parse_date_range(value):
+    """Parse date range 'YYYY-MM-DD..YYYY-MM-DD' to tuple of the first
+    and the last date strings"""
+    first, sep, last = value.partition('..')
+    for x in (first, last):
+        datetime.datetime.strptime(x, '%Y-%m-%d')
+    if not sep or first > last:
+        raise ValueError(f'Wrong date range "{value}"')
+    return first, last
+
+
+def find_archived_files(out_path: Path):
+    """Archived datafiles (see backup_files) of the backup directory as
+    dictionary (YYYY-MM-DD: dictionary (prefix: filename))"""
+    result = dict()
+    for name in sorted(os.listdir(out_path)):
+        if not name.endswith('.backup.zip'):
+            continue
+        name = name[:-len('.backup.zip')]
+        found = datafile_date(name)
+        if found is not None:
+            prefix, dt = found
+            result.setdefault(dt, dict())[prefix] = name
+    return result
+
+
+def parse_archived_files(out_path: Path, files: dict, key: str,
+                         chunk_size=DEFAULT_CHUNK_SIZE, cache_dir=None):
+    """
+    Parse archived datafiles for 'key' date in a worker process
+
+    files - dictionary (prefix: filename), the full set is parsed by
+        parse_day_files, otherwise only terminals file is parsed
+    """
+    captured = dict()
+    for name in files.values():
+        with zipfile.ZipFile(out_path / f'{name}.backup.zip') as zip_file:
+            captured[name] = zip_file.read(name)
+    if len(files) == 3:
+        return parse_day_files(out_path, files, key, chunk_size, cache_dir,
+                               captured=captured)
+    name = files['terminals']
+    return {'terminals': read_terminals_file(out_path / name, cache_dir,
+                                             captured[name])}
+
+
+def reload_day_facts(out_path: Path, files: dict, key: str, parsed, conn,
+                     method='copy', chunk_size=DEFAULT_CHUNK_SIZE):
+    """Replace transactions and passport blacklist rows of 'key' date
+    with the parsed archived files in one transaction"""
+    with conn.cursor() as cursor:
+        cursor.execute('''delete from de10.rdkv_dwh_fact_tracnsactions
+            where trans_date >= cast(%s as timestamp)
+                and trans_date < cast(%s as timestamp) + interval '1 day'
+            ''', (key, key))
+        cursor.execute('''delete from de10.rdkv_dwh_fact_passport_blacklist
+            where entry_dt = %s''', (key, ))
+    load_transactions_file(out_path / files['transactions'], conn, method,
+                           chunk_size, parsed['transactions'])
+    load_passport_blacklist_file(out_path / files['passport_blacklist'], key,
+                                 conn, method, chunk_size,
+                                 parsed['passport_blacklist'])
+    conn.commit()
+    logging.info(f'Facts for {key} are reloaded from the archive')
+
+
+def backfill_day_files(out_path: Path, files: dict, key: str, db_conf,
+                       method='copy', chunk_size=DEFAULT_CHUNK_SIZE,
+                       cache_dir=None):
+    """
+    Parse archived datafiles for 'key' date and reload its facts with a
+    separate connection in a worker process
+
+    files - dictionary (prefix: filename), only terminals are parsed if it
+        is not the full set
+    Return parsed terminals and the stage metrics of the facts (or None)
+    """
+    parsed = parse_archived_files(out_path, files, key, chunk_size,
+                                  cache_dir)
+    if len(files) < 3:
+        return parsed['terminals'], None
+    conn = psycopg2.connect(**db_conf['target'])
+    try:
+        with measure_stage('backfill_facts', date=key) as stage:
+            reload_day_facts(out_path, files, key, parsed, conn, method,
+                             chunk_size)
+    finally:
+        conn.close()
+    return parsed['terminals'], stage
+
+
+def backfill_datafiles(out_path: Path, first: str, last: str, conn_edu,
+                       db_conf, method='copy', chunk_size=DEFAULT_CHUNK_SIZE,
+                       jobs=1, cache_dir=None):
+    """
+    Reload facts for dates from 'first' to 'last' (YYYY-MM-DD) from the
+    archived datafiles, rebuild terminals SCD2 and queue the report
+
+    The archives are parsed and the facts of every date are replaced in a
+    pool of 'jobs' worker processes with their own connections (see
+    backfill_day_files). Terminals SCD2 is rolled back to 'first' and
+    the archived snapshots from 'first' up to the last loaded date are
+    converted again in date order. It is done in one transaction with
+    removal of the report of these dates and their queueing for
+    build_report, so the watermark in rdkv_meta_loads stays the same.
+    """
+    update_dt = get_update_dt_from_meta('de10', 'rdkv_stg_terminals',
+                                        conn_edu)
+    if first > update_dt:
+        logging.warning(f'Files after {update_dt} are not loaded yet, '
+                        'there is nothing to reload')
+        return
+    if last > update_dt:
+        logging.warning(f'Files after {update_dt} are not loaded yet, '
+                        'they are not reloaded')
+        last = update_dt
+    archived = {k: v for k, v in find_archived_files(out_path).items()
+                if first <= k <= update_dt and 'terminals' in v}
+    with conn_edu.cursor() as cursor:
+        # Loaded dates from 'first': versions of terminals, built and
+        # queued reports
+        cursor.execute('''select cast(effective_from as date)
+                from de10.rdkv_dwh_dim_terminals_hist
+                where effective_from >= to_timestamp(%(first)s, 'YYYY-MM-DD')
+            union select report_dt from de10.rdkv_rep_fraud_dates
+                where report_dt >= to_date(%(first)s, 'YYYY-MM-DD')
+            union select load_dt from de10.rdkv_stg_rep_fraud_loads
+                where load_dt >= to_date(%(first)s, 'YYYY-MM-DD')''',
+                       {'first': first})
+        loaded = set(x[0].strftime('%Y-%m-%d') for x in cursor.fetchall())
+    # Terminals versions of all these dates are removed by the rollback, so
+    # every date must be converted again from its archive
+    missing = sorted(x for x in loaded | {update_dt}
+                     if x <= update_dt and x not in archived)
+    if len(missing) > 0:
+        raise Exception(f'Archive of terminals for {", ".join(missing)} is '
+                        f'not found in "{out_path}", SCD2 of terminals can '
+                        'not be rebuilt')
+    replay = sorted(archived)
+    days = [k for k in replay if k <= last and len(archived[k]) == 3]
+    skipped = sorted(set(pd.date_range(first, last).strftime('%Y-%m-%d'))
+                     - set(days))
+    if len(skipped) > 0:
+        logging.warning(f'Files for {", ".join(skipped)} are not found in '
+                        f'"{out_path}" and will not be reloaded')
+    logging.info(f'Reload facts for {len(days)} dates and rebuild SCD2 of '
+                 f'terminals for {len(replay)} dates from {first}')
+    files = {k: archived[k] if k in days
+             else {'terminals': archived[k]['terminals']} for k in replay}
+    scripts = default_path / 'sql_scripts'
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = dict()
+        try:
+            with conn_edu.cursor() as cursor, \
+                    open(scripts / 'terminals_rollback.sql') as f:
+                query = f.read()
+                execute_sql(cursor, query,
+                            replicate_inline_value(first, query),
+                            'terminals_rollback.sql')
+            for i, key in enumerate(replay):
+                # Reload next days in the pool while terminals are converted
+                for k in replay[i:i + jobs + 1]:
+                    if k not in futures:
+                        futures[k] = executor.submit(
+                            backfill_day_files, out_path, files[k], k,
+                            db_conf, method, chunk_size, cache_dir)
+                terminals, stage = futures.pop(key).result()
+                if stage is not None:
+                    add_rows(stage['rows'])
+                    with _metrics_lock:
+                        run_metrics['stages'].append(stage)
+                with measure_stage('terminals', date=key):
+                    load_terminals_file(out_path / files[key]['terminals'],
+                                        conn_edu, method, chunk_size,
+                                        terminals)
+                    convert_terminals_to_scd2(
+                        scripts / 'terminals_to_scd2.sql', key, conn_edu,
+                        commit=False)
+            with conn_edu.cursor() as cursor:
+                # The queued dates are built again by build_report
+                cursor.execute('''delete from de10.rdkv_rep_fraud
+                    where report_dt in (
+                        select load_dt from de10.rdkv_stg_rep_fraud_loads)''')
+            conn_edu.commit()
+        except Exception:
+            conn_edu.rollback()
+            for x in futures.values():
+                x.cancel()
+            raise
+    if cache_dir is not None:
+        # Fingerprint of the last snapshot for the delta terminals mode
+        write_terminals_fingerprint(cache_dir, update_dt,
+                                    terminals_fingerprint(terminals))
+    logging.info(f'Files from {first} to {last} are reloaded')
 
 
 if __name__ == "__main__":
+    started = datetime.datetime.now()
+    metrics_dir, success = None, False
     try:
         # Load and parse command line arguments
         caption = 'Result DE10 Project, Egor Rudikov'
         parser = argparse.ArgumentParser(description=caption)
-        default_path = Path(__file__).resolve().parent
         hint = ('Input directory with files for loading, '
                 'default: basedir of main.py')
         parser.add_argument('--indir', type=str, help=hint)
@@ -396,7 +2265,119 @@ if __name__ == "__main__":
         parser.add_argument('--dbconf', type=str, help=hint)
         hint = 'Set logging level (info, warning, error), default: info'
         parser.add_argument('--log', type=str, help=hint)
+        hint = ('Method of writing rows from datafiles to the database '
+                '(copy, batch), default: copy')
+        parser.add_argument('--loader', type=str, choices=LOADERS,
+                            default='copy', help=hint)
+        hint = ('Amount of rows per one COPY command, '
+                f'default: {DEFAULT_CHUNK_SIZE}')
+        parser.add_argument('--chunk-size', type=int,
+                            default=DEFAULT_CHUNK_SIZE, help=hint)
+        hint = ('Amount of worker processes for parsing datafiles of the '
+                'next days while the current day is loaded, default: 1 '
+                '(sequential loading)')
+        parser.add_argument('--jobs', type=int, default=1, help=hint)
+        hint = ('Directory for the cache of parsed xlsx files in parquet '
+                'format (requires pyarrow), default: no cache')
+        parser.add_argument('--cache-dir', type=str, help=hint)
+        hint = ('Conversion of terminals to SCD2: full (compare the whole '
+                'snapshot in the database) or delta (load only the rows '
+                'changed since the previous snapshot, its fingerprint is '
+                'kept in the cache directory), default: full')
+        parser.add_argument('--terminals-mode', type=str,
+                            choices=TERMINALS_MODES, default='full',
+                            help=hint)
+        hint = ('Compression method of the archived datafiles (deflated, '
+                'bzip2, lzma, stored), default: deflated')
+        parser.add_argument('--archive-codec', type=str,
+                            choices=ARCHIVE_CODECS, default='deflated',
+                            help=hint)
+        hint = ('Compression level of the archived datafiles (0-9 for '
+                'deflated, 1-9 for bzip2, lzma and stored have no level), '
+                'default: 9 for deflated and bzip2')
+        parser.add_argument('--archive-level', type=int, help=hint)
+        hint = ('Amount of threads compressing datafiles of a day, '
+                'default: 3')
+        parser.add_argument('--archive-jobs', type=int, default=3, help=hint)
+        hint = ('Keep content of datafiles in memory after parsing, so '
+                'every file is read from disk once for loading and archiving')
+        parser.add_argument('--archive-capture', action='store_true',
+                            help=hint)
+        hint = ('Engine of SCD1 to SCD2 conversion for source tables '
+                '(hash, join), default: hash')
+        parser.add_argument('--scd2-engine', type=str, choices=SCD2_ENGINES,
+                            default='hash', help=hint)
+        hint = ('Way of finding deleted rows in source tables (checksum, '
+                'full), default: full')
+        parser.add_argument('--deletion', type=str, choices=DELETION_MODES,
+                            default='full', help=hint)
+        hint = ('Amount of buckets of primary keys for checksum deletion '
+                f'mode, default: {DEFAULT_BUCKETS}')
+        parser.add_argument('--buckets', type=int, default=DEFAULT_BUCKETS,
+                            help=hint)
+        hint = ('Engine for fraud types 3 and 4 in the report (sql, '
+                'python), default: sql')
+        parser.add_argument('--report-engine', type=str,
+                            choices=REPORT_ENGINES, default='sql', help=hint)
+        hint = ('Report mode: cumulative (copy records of previous days to '
+                'every report) or incremental (add only new events, the '
+                'cumulative report is view rdkv_v_rep_fraud), default: '
+                'cumulative')
+        parser.add_argument('--report-mode', type=str, choices=REPORT_MODES,
+                            default='cumulative', help=hint)
+        hint = ('Remove records of previous days from the report table '
+                '(migration to the incremental report mode)')
+        parser.add_argument('--compact-report', action='store_true',
+                            help=hint)
+        hint = ('Build report for all queued dates in one set-based pass '
+                'with one commit instead of a commit per date')
+        parser.add_argument('--report-batch', action='store_true', help=hint)
+        hint = ('Engine for enrichment of transactions with cards, accounts '
+                'and clients in the report (sql - range joins, python - '
+                'in-memory interval indexes of SCD2 history), default: sql. '
+                'The indexes are built from the whole history at the start '
+                'of the process and refreshed incrementally, so python '
+                'engine pays off only with --watch and a deep history')
+        parser.add_argument('--enrich-engine', type=str,
+                            choices=ENRICH_ENGINES, default='sql', help=hint)
+        hint = ('Directory for metrics of the run (wall time, rows, rows/sec '
+                'and peak memory of the stages and SQL statements): json '
+                'summary run_YYYYMMDD_HHMMSS.json and Prometheus textfile '
+                'rdkv_etl.prom, default: no metrics')
+        parser.add_argument('--metrics', type=str, help=hint)
+        hint = ('Save EXPLAIN (ANALYZE, BUFFERS) plans of the report and SCD2 '
+                'statements to explain_YYYYMMDD_HHMMSS.txt in the metrics '
+                'directory')
+        parser.add_argument('--explain', action='store_true', help=hint)
+        mode = parser.add_mutually_exclusive_group()
+        hint = ('Run as a service: watch the input directory and load every '
+                'full set of datafiles as soon as it is written, then build '
+                'the report (until SIGTERM), default: one run (cron mode)')
+        mode.add_argument('--watch', action='store_true', help=hint)
+        hint = ('Reload facts for the dates FROM..TO (YYYY-MM-DD..YYYY-MM-DD) '
+                'from the archived files of the backup directory, rebuild '
+                'SCD2 of terminals and the report since FROM (--jobs worker '
+                'processes and connections)')
+        mode.add_argument('--backfill', type=parse_date_range,
+                          metavar='FROM..TO', help=hint)
+        hint = ('Interval of checking the input directory in the watch mode '
+                f'in seconds, default: {DEFAULT_POLL_INTERVAL}')
+        parser.add_argument('--poll-interval', type=float,
+                            default=DEFAULT_POLL_INTERVAL, help=hint)
+        hint = ('Files modified less than this amount of seconds ago are not '
+                'loaded in the watch mode (they are being written), default: '
+                f'{DEFAULT_SETTLE_TIME}')
+        parser.add_argument('--settle-time', type=float,
+                            default=DEFAULT_SETTLE_TIME, help=hint)
         args = parser.parse_args()
+        # Check compression level before any data is loaded
+        levels = ARCHIVE_LEVELS[args.archive_codec]
+        if args.archive_level is None:
+            args.archive_level = None if levels is None else max(levels)
+        elif levels is None or args.archive_level not in levels:
+            parser.error(f'--archive-codec {args.archive_codec} accepts '
+                         + ('no --archive-level' if levels is None else
+                            f'--archive-level {min(levels)}-{max(levels)}'))
         # Set default values for command line arguments
         log_level = logging.INFO
         if args.log is not None:
@@ -413,42 +2394,74 @@ if __name__ == "__main__":
         outdir = default_path / 'archive' \
             if args.indir is None else Path(args.outdir).resolve()
         logging.info(f'Set "{outdir}" as a backup directory')
+        cache_dir = None
+        if args.cache_dir is not None:
+            cache_dir = Path(args.cache_dir).resolve()
+            logging.info(f'Set "{cache_dir}" as a cache directory')
+            if pyarrow is None:
+                logging.warning('pyarrow is not installed, the parsed xlsx '
+                                'files will not be cached')
+        elif args.terminals_mode == 'delta':
+            logging.warning('The delta terminals mode requires the cache '
+                            'directory, the full mode is used')
+        if args.metrics is not None:
+            metrics_dir = Path(args.metrics).resolve()
+            logging.info(f'Set "{metrics_dir}" as a metrics directory')
+            if args.explain:
+                metrics_dir.mkdir(parents=True, exist_ok=True)
+                explain_path = metrics_dir / \
+                    f'explain_{started:%Y%m%d_%H%M%S}.txt'
+        elif args.explain:
+            logging.warning('Plans of the statements are saved only with '
+                            'the metrics directory (--metrics)')
         db_conf_path = default_path / 'py_scripts/default_dbconf.json' \
             if args.dbconf is None else Path(args.dbconf).resolve()
         logging.info(f'Set "{db_conf_path}" as a DB configuration file')
         with open(db_conf_path) as f:
             json_db_congig = f.read()
         db_conf = json.loads(json_db_congig)
-        # Connect to target database ("edu")
-        with psycopg2.connect(**db_conf['target']) as conn_edu:
+        # Connect to target database ("edu"), the connection is closed
+        # before the watch mode which opens its own one
+        with contextlib.closing(psycopg2.connect(**db_conf['target'])) \
+                as conn_edu, conn_edu:
             msg = 'Connection to "target" database is successfully opened'
             logging.info(msg)
             conn_edu.autocommit = False
             # Initialize target database
-            ddl_init(default_path / 'main.ddl', conn_edu)
-            with conn_edu.cursor() as cursor:
-                # Fix now variable
-                cursor.execute('select cast(now() as timestamp(0))')
-                now = cursor.fetchone()[0]
-            # Connect to source database ("bank")
-            with psycopg2.connect(**db_conf['source']) as conn_bank:
-                msg = 'Connection to "source" database is successfully opened'
-                logging.info(msg)
-                conn_bank.autocommit = True
-                # Grab data from source and converting to SCD2 format in target
-                convert_scd1_to_scd2('accounts', 'account',
-                                     {'account': 'account_num'},
-                                     conn_bank, conn_edu, now)
-                convert_scd1_to_scd2('cards', 'card_num',
-                                     {'account': 'account_num'},
-                                     conn_bank, conn_edu, now)
-                convert_scd1_to_scd2('clients', 'client_id', None,
-                                     conn_bank, conn_edu, now)
-            # datafiles processing
-            load_datafiles(indir, outdir, conn_edu)
-            # report processing
-            build_report(default_path / 'sql_scripts' / 'rep.sql', conn_edu)
-            logging.info('Finish working...')
+            with measure_stage('ddl_init'):
+                ddl_init(default_path / 'main.ddl', conn_edu)
+            if args.compact_report:
+                with measure_stage('compact_report'):
+                    compact_report(default_path / 'sql_scripts' /
+                                   'rep_compact.sql', conn_edu)
+            if args.backfill is not None:
+                with run_lock(conn_edu):
+                    with measure_stage('backfill'):
+                        backfill_datafiles(outdir, *args.backfill, conn_edu,
+                                           db_conf, args.loader,
+                                           args.chunk_size, args.jobs,
+                                           cache_dir)
+                    # The dates are built in one set-based pass
+                    with measure_stage('report'):
+                        build_report(default_path / 'sql_scripts' /
+                                     'rep.sql', conn_edu, args.report_engine,
+                                     args.chunk_size, args.report_mode, True,
+                                     args.enrich_engine)
+            elif not args.watch:
+                with run_lock(conn_edu):
+                    run_etl(indir, outdir, conn_edu, db_conf, args,
+                            cache_dir)
+        if args.watch:
+            # Metrics are saved after every run of the watch mode
+            watch_datafiles(indir, outdir, db_conf, args, cache_dir,
+                            metrics_dir)
+            metrics_dir = None
+        logging.info('Finish working...')
+        success = True
     except Exception as ex:
         print(ex)
         logging.error('Exception occurred', exc_info=True)
+    finally:
+        if metrics_dir is not None:
+            write_metrics(metrics_dir, started, success)
+            logging.info(f'Metrics of the run are saved to "{metrics_dir}"')
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+"""
+Benchmark of the enrichment engines at growing depth of SCD2 history
+
+Fills de10.rdkv_stg_rep_fraud_tmp for the last loaded date (e.g. after
+loading the files made by gen_data.py) with the range joins of
+sql_scripts/rep_tmp.sql and with the in-memory interval indexes
+(main.enrich_transactions): with the empty cache and with the refreshed
+one. Before every step older versions are added to every key of cards,
+accounts and clients history, so the joins scan more versions. The
+content of the filled tables is compared and all the changes are rolled
+back at the end.
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import psycopg2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main  # noqa: E402
+
+# Length of the simulated old versions
+PERIOD = '7 days'
+
+
+def add_versions(table, versions, offset):
+    """Add 'versions' versions to every key of the hist table before the
+    earliest version (after 'offset' already added ones)"""
+    key, columns, _ = main.ENRICH_DIMENSIONS[table]
+    columns = [key, *(x for x in columns if x != 'deleted_flg'),
+               'deleted_flg']
+    hist = f'de10.rdkv_dwh_dim_{table}_hist'
+    return f'''insert into {hist}({", ".join(columns)},
+            effective_from, effective_to)
+        select {", ".join("h." + x for x in columns)},
+            b.first_dt - interval '{PERIOD}' * (k + 1),
+            b.first_dt - interval '{PERIOD}' * k - interval '1 second'
+        from (select distinct on ({key}) * from {hist}
+            where {key} is not null and deleted_flg = 'N'
+            order by {key}, effective_from) h
+        cross join (select min(effective_from) first_dt from {hist}) b
+        cross join generate_series({offset}, {offset + versions - 1}) k;
+        analyze {hist}'''
+
+
+def tmp_checksum(cursor):
+    cursor.execute('''select count(*), md5(string_agg(t::text, ','
+            order by t::text))
+        from de10.rdkv_stg_rep_fraud_tmp t''')
+    return cursor.fetchone()
+
+
+def measure(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    default_path = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    hint = ('Path to the file with databases connections '
+            'configuration, default: py_scripts/default_dbconf.json')
+    parser.add_argument('--dbconf', type=str, help=hint,
+                        default=default_path / 'py_scripts' /
+                        'default_dbconf.json')
+    parser.add_argument('--depths', type=int, nargs='+',
+                        default=[0, 5, 10, 20],
+                        help='Amounts of old versions per key (in growing '
+                        'order), default: 0 5 10 20')
+    args = parser.parse_args()
+    with open(args.dbconf) as f:
+        db_conf = json.loads(f.read())
+    with open(default_path / 'sql_scripts' / 'rep_tmp.sql') as f:
+        query = f.read()
+    failed = 0
+    with psycopg2.connect(**db_conf['target']) as conn:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('''select cast(max(trans_date) as date)
+                    from de10.rdkv_dwh_fact_tracnsactions''')
+                date = cursor.fetchone()[0]
+                print(f'Enrichment of transactions for {date}')
+                added = 0
+                for depth in sorted(args.depths):
+                    if depth > added:
+                        for table in main.ENRICH_DIMENSIONS:
+                            cursor.execute(add_versions(table, depth - added,
+                                                        added))
+                        added = depth
+                    versions = 0
+                    for table in main.ENRICH_DIMENSIONS:
+                        cursor.execute('select count(*) from '
+                                       f'de10.rdkv_dwh_dim_{table}_hist')
+                        versions += cursor.fetchone()[0]
+                    sql = measure(lambda: cursor.execute(
+                        query, main.replicate_inline_value(date, query)))
+                    expected = tmp_checksum(cursor)
+                    main.dimension_cache.clear()
+                    cold = measure(lambda: main.enrich_transactions(
+                        (date, ), conn))
+                    same = tmp_checksum(cursor) == expected
+                    warm = measure(lambda: main.enrich_transactions(
+                        (date, ), conn))
+                    same &= tmp_checksum(cursor) == expected
+                    failed += not same
+                    print(f'depth {depth:>3} ({versions} versions): '
+                          f'{expected[0]} rows, sql {sql:.3f} s, python '
+                          f'{cold:.3f} s (empty cache), {warm:.3f} s '
+                          '(refreshed cache), '
+                          f'{"OK" if same else "DIFFERENT"}')
+        finally:
+            conn.rollback()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+"""
+Benchmark of writing datafile rows to the database: COPY vs execute_batch
+
+Every run writes the rows to a temporary copy of the target table, so
+the data in the de10 schema is not changed.
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+import psycopg2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main  # noqa: E402
+
+
+def bench(df, method, chunk_size, repeat, conn):
+    columns = ('trans_id', 'trans_date', 'amt', 'card_num', 'oper_type',
+               'oper_result', 'terminal')
+    timings = []
+    with conn.cursor() as cursor:
+        for _ in range(repeat):
+            cursor.execute('''create temp table bench_transactions
+            (like de10.rdkv_dwh_fact_tracnsactions)''')
+            start = time.perf_counter()
+            main.write_rows(cursor, 'bench_transactions', columns, df,
+                            method, chunk_size)
+            timings.append(time.perf_counter() - start)
+            conn.rollback()
+    return min(timings)
+
+
+if __name__ == "__main__":
+    default_path = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    hint = 'File with transactions, default: transactions_01032021.txt'
+    parser.add_argument('--file', type=str, help=hint,
+                        default=default_path / 'transactions_01032021.txt')
+    hint = ('Path to the file with databases connections '
+            'configuration, default: py_scripts/default_dbconf.json')
+    parser.add_argument('--dbconf', type=str, help=hint,
+                        default=default_path / 'py_scripts' /
+                        'default_dbconf.json')
+    parser.add_argument('--chunk-size', type=int,
+                        default=main.DEFAULT_CHUNK_SIZE,
+                        help='Amount of rows per one COPY command')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Amount of runs per method, the best is taken')
+    args = parser.parse_args()
+    df = pd.read_csv(args.file, sep=';', decimal=',',
+                     parse_dates=['transaction_date'])
+    with open(args.dbconf) as f:
+        db_conf = json.loads(f.read())
+    with psycopg2.connect(**db_conf['target']) as conn:
+        for method in main.LOADERS:
+            elapsed = bench(df, method, args.chunk_size, args.repeat, conn)
+            print(f'{method:>6}: {df.shape[0]} rows, {elapsed:.3f} s, '
+                  f'{df.shape[0] / elapsed:,.0f} rows/sec')
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""
+Benchmark of the report build time over many simulated days
+
+Transactions of the first loaded date (e.g. after loading the sample
+files by main.py) are copied to the next days one day at a time and the
+report is built and committed for every simulated day like in the daily
+runs. The simulated partitions and reports are removed at the end, use
+a separate database for the benchmark.
+"""
+
+import argparse
+import datetime
+import json
+import sys
+import time
+from pathlib import Path
+
+import psycopg2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main  # noqa: E402
+
+COLUMNS = ('trans_id', 'trans_date', 'amt', 'card_num', 'oper_type',
+           'oper_result', 'terminal')
+
+
+def run_days(start, days, template, mode, engine, step, conn):
+    """Load template transactions and build report for every day"""
+    script = main.default_path / 'sql_scripts' / 'rep.sql'
+    first = template[0][0].date()
+    timings = []
+    with conn.cursor() as cursor:
+        for k in range(days):
+            date = start + datetime.timedelta(days=k)
+            shift = date - first
+            # Copy the template day to the simulated date
+            main.create_transactions_partitions({date}, conn)
+            main.copy_rows(cursor, 'de10.rdkv_dwh_fact_tracnsactions',
+                           COLUMNS, ((f'{k:03d}{i:08d}', x[0] + shift, *x[1:])
+                                     for i, x in enumerate(template)))
+            cursor.execute('analyze de10.rdkv_dwh_fact_tracnsactions_'
+                           f'{date.strftime("%Y%m%d")}')
+            conn.commit()
+            begin = time.perf_counter()
+            main.build_date_report(script, date, conn, engine, mode=mode)
+            conn.commit()
+            timings.append(time.perf_counter() - begin)
+            if (k + 1) % step == 0:
+                cursor.execute('select count(*) from de10.rdkv_rep_fraud')
+                print(f'day {k + 1:>4} ({date}): {timings[-1]:.3f} s, '
+                      f'{cursor.fetchone()[0]} rows in rdkv_rep_fraud')
+    return timings
+
+
+def simulate(days, mode, engine, rows, step, conn):
+    with conn.cursor() as cursor:
+        cursor.execute('''select min(trans_date), max(trans_date)
+            from de10.rdkv_dwh_fact_tracnsactions''')
+        first, last = cursor.fetchone()
+        cursor.execute(f'''select {", ".join(COLUMNS[1:])}
+            from de10.rdkv_dwh_fact_tracnsactions
+            where trans_date >= %s and trans_date < %s
+            order by trans_date limit %s''',
+                       (first.date(), first.date() + datetime.timedelta(1),
+                        rows))
+        template = cursor.fetchall()
+        start = last.date() + datetime.timedelta(days=1)
+        try:
+            return run_days(start, days, template, mode, engine, step, conn)
+        finally:
+            conn.rollback()
+            # Remove simulated data
+            for k in range(days):
+                date = start + datetime.timedelta(days=k)
+                cursor.execute('drop table if exists de10.rdkv_dwh_fact_'
+                               f'tracnsactions_{date.strftime("%Y%m%d")}')
+            cursor.execute('delete from de10.rdkv_rep_fraud '
+                           'where report_dt >= %s', (start, ))
+            cursor.execute('delete from de10.rdkv_rep_fraud_dates '
+                           'where report_dt >= %s', (start, ))
+            conn.commit()
+
+
+if __name__ == "__main__":
+    default_path = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    hint = ('Path to the file with databases connections '
+            'configuration, default: py_scripts/default_dbconf.json')
+    parser.add_argument('--dbconf', type=str, help=hint,
+                        default=default_path / 'py_scripts' /
+                        'default_dbconf.json')
+    parser.add_argument('--days', type=int, default=365,
+                        help='Amount of simulated days, default: 365')
+    parser.add_argument('--rows', type=int, default=20000,
+                        help='Maximum amount of transactions per day')
+    parser.add_argument('--step', type=int, default=30,
+                        help='Print timing for every step-th day')
+    parser.add_argument('--mode', type=str, choices=main.REPORT_MODES,
+                        default='incremental', help='Report mode')
+    parser.add_argument('--engine', type=str, choices=main.REPORT_ENGINES,
+                        default='sql', help='Engine for fraud types 3 and 4')
+    args = parser.parse_args()
+    with open(args.dbconf) as f:
+        db_conf = json.loads(f.read())
+    with psycopg2.connect(**db_conf['target']) as conn:
+        timings = simulate(args.days, args.mode, args.engine, args.rows,
+                           args.step, conn)
+    n = max(1, min(30, len(timings) // 2))
+    print(f'{args.mode}: first {n} days {sum(timings[:n]) / n:.3f} s/day, '
+          f'last {n} days {sum(timings[-n:]) / n:.3f} s/day')
@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+"""
+End-to-end benchmark of the ETL stages against a local PostgreSQL
+
+Runs the stages on the datafiles of the input directory (e.g. made by
+gen_data.py, the files are only read) and the "source" database:
+    scd2 - replication of the source tables to SCD2 (convert_scd1_to_scd2)
+    datafiles - loading of transactions and passport blacklist files
+    terminals - conversion of terminals files to SCD2
+    report - building of the report for the loaded dates
+Every stage runs in a separate process, so its peak memory is measured
+without the previous stages. Throughput, latency per day and peak memory
+of every stage are printed and saved to a json file for comparison with
+the previous runs (--compare). Use a separate target database: the stages
+change it like the daily runs and --reset drops all rdkv tables.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+
+import psycopg2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main  # noqa: E402
+
+STAGES = ('scd2', 'datafiles', 'terminals', 'report')
+
+
+def day_files(in_path):
+    """Dates (YYYY-MM-DD) with full sets of datafiles and their names"""
+    days = dict()
+    for name in sorted(os.listdir(in_path)):
+        found = main.datafile_date(name)
+        if found is not None:
+            prefix, key = found
+            days.setdefault(key, dict())[prefix] = name
+    return {k: v for k, v in sorted(days.items())
+            if len(v) == len(main.DATAFILES)}
+
+
+def stage_scd2(db_conf, args):
+    with psycopg2.connect(**db_conf['source']) as conn, conn.cursor() as c:
+        c.execute('''select (select count(*) from info.accounts)
+            + (select count(*) from info.cards)
+            + (select count(*) from info.clients)''')
+        rows = c.fetchone()[0]
+    with psycopg2.connect(**db_conf['target']) as conn, conn.cursor() as c:
+        c.execute('select cast(now() as timestamp(0))')
+        now = c.fetchone()[0]
+    start = time.perf_counter()
+    main.replicate_scd1_tables(main.SCD1_TABLES, db_conf, now,
+                               db_conf.get('pool_size', 1),
+                               engine=args.scd2_engine,
+                               batch_size=args.chunk_size,
+                               deletion=args.deletion)
+    return rows, [time.perf_counter() - start]
+
+
+def count_rows(chunks, counter):
+    """Pass the parsed chunks through to the loader counting their rows"""
+    for df, bad in chunks:
+        counter[0] += df.shape[0]
+        yield df, bad
+
+
+def stage_datafiles(db_conf, args):
+    in_path = Path(args.indir)
+    rows, timings = [0], []
+    with psycopg2.connect(**db_conf['target']) as conn:
+        for key, files in day_files(in_path).items():
+            start = time.perf_counter()
+            # The chunks are streamed, so peak memory is the loader's one
+            chunks = count_rows(main.read_transactions_file(
+                in_path / files['transactions'], args.chunk_size), rows)
+            parsed = main.read_passport_blacklist_file(
+                in_path / files['passport_blacklist'], key, args.cache_dir)
+            main.load_transactions_file(in_path / files['transactions'],
+                                        conn, args.loader, args.chunk_size,
+                                        chunks)
+            main.load_passport_blacklist_file(
+                in_path / files['passport_blacklist'], key, conn,
+                args.loader, args.chunk_size, parsed)
+            conn.commit()
+            timings.append(time.perf_counter() - start)
+            rows[0] += parsed[0].shape[0]
+    return rows[0], timings
+
+
+def stage_terminals(db_conf, args):
+    in_path = Path(args.indir)
+    rows, timings = 0, []
+    with psycopg2.connect(**db_conf['target']) as conn:
+        for key, files in day_files(in_path).items():
+            start = time.perf_counter()
+            path = in_path / files['terminals']
+            df = main.read_terminals_file(path, args.cache_dir)
+            main.terminals_to_scd2(path, key, conn, args.loader,
+                                   args.chunk_size, df, args.cache_dir,
+                                   args.terminals_mode)
+            timings.append(time.perf_counter() - start)
+            rows += df.shape[0]
+    return rows, timings
+
+
+def stage_report(db_conf, args):
+    script = main.default_path / 'sql_scripts' / 'rep.sql'
+    timings = []
+    with psycopg2.connect(**db_conf['target']) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('''select count(*)
+                from de10.rdkv_dwh_fact_tracnsactions t
+                inner join (select distinct load_dt
+                    from de10.rdkv_stg_rep_fraud_loads) l
+                    on t.trans_date >= l.load_dt
+                    and t.trans_date < l.load_dt + interval '1 day' ''')
+            rows = cursor.fetchone()[0]
+            cursor.execute('select load_dt from de10.rdkv_stg_rep_fraud_loads')
+            dates = sorted(set(x[0] for x in cursor.fetchall()))
+        if args.report_batch:
+            start = time.perf_counter()
+            main.build_report(script, conn, args.report_engine,
+                              args.chunk_size, args.report_mode, True)
+            timings.append(time.perf_counter() - start)
+        for date in dates if not args.report_batch else ():
+            start = time.perf_counter()
+            main.build_date_report(script, date, conn, args.report_engine,
+                                   args.chunk_size, args.report_mode)
+            conn.commit()
+            timings.append(time.perf_counter() - start)
+    return rows, timings
+
+
+def run_stage(name, db_conf, args):
+    """Run the stage in the current (worker) process and return metrics"""
+    cpu = time.process_time()
+    rows, timings = globals()[f'stage_{name}'](db_conf, args)
+    elapsed = sum(timings)
+    return {'rows': rows,
+            'seconds': round(elapsed, 3),
+            'rows_per_sec': round(rows / elapsed, 1) if elapsed else None,
+            'latency_mean': round(elapsed / len(timings), 3)
+            if timings else None,
+            'latency_max': round(max(timings), 3) if timings else None,
+            'units': len(timings),
+            'cpu_seconds': round(time.process_time() - cpu, 3),
+            # ru_maxrss is in kilobytes on Linux
+            'peak_memory_mb': round(resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+def reset_target(conn):
+    """Drop all rdkv tables and views of the de10 schema"""
+    with conn.cursor() as cursor:
+        cursor.execute('''select table_name, table_type
+            from information_schema.tables
+            where table_schema = 'de10' and table_name like 'rdkv%'
+            order by table_type desc''')
+        for name, kind in cursor.fetchall():
+            kind = 'view' if kind == 'VIEW' else 'table'
+            cursor.execute(f'drop {kind} if exists de10.{name} cascade')
+    conn.commit()
+
+
+def compare(results, path):
+    with open(path) as f:
+        previous = json.loads(f.read())
+    print(f'Comparison with {path} ({previous["started"]}):')
+    for name, metrics in results['stages'].items():
+        old = previous['stages'].get(name)
+        if old is None or not old['seconds'] or not metrics['seconds']:
+            continue
+        print(f'{name:>10}: {old["seconds"]:.3f} -> {metrics["seconds"]:.3f}'
+              f' s ({old["seconds"] / metrics["seconds"]:.2f}x), peak '
+              f'memory {old["peak_memory_mb"]} -> '
+              f'{metrics["peak_memory_mb"]} MB')
+
+
+if __name__ == "__main__":
+    default_path = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    hint = ('Path to the file with databases connections '
+            'configuration, default: py_scripts/default_dbconf.json')
+    parser.add_argument('--dbconf', type=str, help=hint,
+                        default=default_path / 'py_scripts' /
+                        'default_dbconf.json')
+    parser.add_argument('--indir', type=str, required=True,
+                        help='Directory with datafiles')
+    parser.add_argument('--stages', type=str, nargs='+', choices=STAGES,
+                        default=list(STAGES), help='Stages to run in order')
+    parser.add_argument('--results', type=str,
+                        default=default_path / 'py_scripts' / 'bench_results',
+                        help='Directory for json files with results')
+    parser.add_argument('--compare', type=str,
+                        help='Json file of a previous run for comparison')
+    parser.add_argument('--reset', action='store_true',
+                        help='Drop all rdkv tables of the target database '
+                        'before the run')
+    parser.add_argument('--loader', type=str, choices=main.LOADERS,
+                        default='copy')
+    parser.add_argument('--chunk-size', type=int,
+                        default=main.DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--scd2-engine', type=str, choices=main.SCD2_ENGINES,
+                        default='hash')
+    parser.add_argument('--deletion', type=str, choices=main.DELETION_MODES,
+                        default='full')
+    parser.add_argument('--terminals-mode', type=str,
+                        choices=main.TERMINALS_MODES, default='full')
+    parser.add_argument('--cache-dir', type=str,
+                        help='Cache directory of parsed xlsx files')
+    parser.add_argument('--report-engine', type=str,
+                        choices=main.REPORT_ENGINES, default='sql')
+    parser.add_argument('--report-mode', type=str, choices=main.REPORT_MODES,
+                        default='cumulative')
+    parser.add_argument('--report-batch', action='store_true')
+    args = parser.parse_args()
+    with open(args.dbconf) as f:
+        db_conf = json.loads(f.read())
+    with psycopg2.connect(**db_conf['target']) as conn:
+        if args.reset:
+            reset_target(conn)
+        main.ddl_init(default_path / 'main.ddl', conn)
+    started = datetime.datetime.now()
+    results = {'started': started.isoformat(timespec='seconds'),
+               'args': {k: str(v) for k, v in vars(args).items()},
+               'stages': dict()}
+    context = multiprocessing.get_context('spawn')
+    for name in args.stages:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=context) as executor:
+            metrics = executor.submit(run_stage, name, db_conf, args).result()
+        results['stages'][name] = metrics
+        print(f'{name:>10}: {metrics["rows"]} rows, {metrics["seconds"]:.3f} '
+              f's, {metrics["rows_per_sec"] or 0:,.0f} rows/sec, latency '
+              f'{metrics["latency_mean"]:.3f} s (max '
+              f'{metrics["latency_max"]:.3f} s) per {metrics["units"]} units, '
+              f'peak memory {metrics["peak_memory_mb"]} MB')
+    out = Path(args.results)
+    out.mkdir(parents=True, exist_ok=True)
+    path = out / f'bench_{datetime.datetime.now():%Y%m%d_%H%M%S}.json'
+    with open(path, 'w') as f:
+        f.write(json.dumps(results, indent=4))
+    print(f'Results are saved to {path}')
+    if args.compare is not None:
+        compare(results, args.compare)
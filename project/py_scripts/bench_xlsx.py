@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+"""
+Benchmark of parsing xlsx files: pd.read_excel vs streaming reader vs cache
+
+The rows of the file are repeated to the given amount in a temporary
+copy, the parsed DataFrames of all ways are checked to be equal.
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import openpyxl
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main  # noqa: E402
+
+
+def make_file(path, rows, target):
+    book = openpyxl.load_workbook(path, read_only=True)
+    data = list(book.worksheets[0].iter_rows(values_only=True))
+    book.close()
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet()
+    sheet.append(data[0])
+    for i in range(rows):
+        sheet.append(data[1 + i % (len(data) - 1)])
+    book.save(target)
+
+
+def bench(name, func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = func()
+        timings.append(time.perf_counter() - start)
+    elapsed = min(timings)
+    print(f'{name:>12}: {df.shape[0]} rows, {elapsed:.3f} s, '
+          f'{df.shape[0] / elapsed:,.0f} rows/sec')
+    return df
+
+
+if __name__ == "__main__":
+    default_path = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    hint = 'Source xlsx file, default: terminals_01032021.xlsx'
+    parser.add_argument('--file', type=str, help=hint,
+                        default=default_path / 'terminals_01032021.xlsx')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='Amount of rows in the benchmark file')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Amount of runs per way, the best is taken')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'bench.xlsx'
+        make_file(args.file, args.rows, path)
+        cache_dir = Path(tmp) / 'cache'
+        frames = [bench('read_excel', lambda: pd.read_excel(path),
+                        args.repeat),
+                  bench('streaming', lambda: main.read_xlsx_file(path),
+                        args.repeat)]
+        if main.pyarrow is not None:
+            # The first run fills the cache
+            main.read_cached_xlsx_file(path, cache_dir)
+            frames.append(bench('cache', lambda: main.read_cached_xlsx_file(
+                path, cache_dir), args.repeat))
+        else:
+            print('pyarrow is not installed, the cache is skipped')
+    for df in frames[1:]:
+        pd.testing.assert_frame_equal(frames[0], df, check_exact=True)
+    print('The parsed DataFrames are equal')
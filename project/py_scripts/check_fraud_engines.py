@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+"""
+Conformance check of the report engines for fraud types 3 and 4
+
+Builds the report for every date of the loaded transactions (e.g. after
+loading transactions_0*032021.txt by main.py) with "sql" and "python"
+engines and compares the rows. All the changes are rolled back.
+"""
+
+import argparse
+import collections
+import json
+import sys
+from pathlib import Path
+
+import psycopg2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main  # noqa: E402
+
+
+def report_rows(date, engine, batch_size, conn):
+    script = main.default_path / 'sql_scripts' / 'rep.sql'
+    try:
+        main.build_date_report(script, date, conn, engine, batch_size)
+        with conn.cursor() as cursor:
+            cursor.execute('''select event_dt, passport, fio, phone,
+                event_type, report_dt from de10.rdkv_rep_fraud
+                where report_dt = %s and event_type in (3, 4)''', (date, ))
+            return collections.Counter(cursor.fetchall())
+    finally:
+        conn.rollback()
+
+
+if __name__ == "__main__":
+    default_path = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    hint = ('Path to the file with databases connections '
+            'configuration, default: py_scripts/default_dbconf.json')
+    parser.add_argument('--dbconf', type=str, help=hint,
+                        default=default_path / 'py_scripts' /
+                        'default_dbconf.json')
+    parser.add_argument('--batch-size', type=int,
+                        default=main.DEFAULT_CHUNK_SIZE,
+                        help='Amount of rows per batch for python engine')
+    args = parser.parse_args()
+    with open(args.dbconf) as f:
+        db_conf = json.loads(f.read())
+    failed = 0
+    with psycopg2.connect(**db_conf['target']) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('''select distinct cast(trans_date as date)
+                from de10.rdkv_dwh_fact_tracnsactions order by 1''')
+            dates = [x[0] for x in cursor.fetchall()]
+        for date in dates:
+            rows = {engine: report_rows(date, engine, args.batch_size, conn)
+                    for engine in main.REPORT_ENGINES}
+            is_same = rows['sql'] == rows['python']
+            failed += not is_same
+            print(f'{date}: sql {sum(rows["sql"].values())} rows, '
+                  f'python {sum(rows["python"].values())} rows, '
+                  f'{"OK" if is_same else "DIFFERENT"}')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+"""
+Check of the chunked transactions parser on files with bad rows
+
+Writes a copy of the transactions file with blank, malformed and
+unparsable rows (also runs of them longer than a chunk, so some chunks
+have no valid rows) and loads it by main.load_transactions_file with
+several chunk sizes. The amount of loaded rows is compared with the
+valid rows of the original file and all the changes are rolled back.
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+import psycopg2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main  # noqa: E402
+
+# Rows which are skipped by the parser
+BAD_ROWS = ('\n', 'broken row\n', ';;;;;;\n',
+            '1;2021-03-01 00:00:01;1,00;card;PAYMENT;SUCCESS\n',
+            '2;not a date;1,00;card;PAYMENT;SUCCESS;P1\n',
+            '3;2021-03-01 00:00:01;amount;card;PAYMENT;SUCCESS;P1\n')
+
+
+def write_bad_file(source: Path, path: Path):
+    """Copy of the file with all BAD_ROWS after the header and after every
+    100th row, returns amount of valid rows"""
+    with open(source) as f:
+        header, *rows = f.readlines()
+    with open(path, 'w') as f:
+        f.write(header)
+        f.writelines(BAD_ROWS)
+        for i, row in enumerate(rows):
+            f.write(row)
+            if i % 100 == 99:
+                f.writelines(BAD_ROWS)
+    return len(rows)
+
+
+def loaded_rows(path: Path, chunk_size, conn):
+    try:
+        main.run_metrics['stages'].clear()
+        with main.measure_stage('check'):
+            main.load_transactions_file(path, conn, 'copy', chunk_size)
+        return main.run_metrics['stages'][-1]['rows']
+    finally:
+        conn.rollback()
+
+
+if __name__ == "__main__":
+    default_path = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    hint = 'File with transactions, default: transactions_01032021.txt'
+    parser.add_argument('--file', type=str, help=hint,
+                        default=default_path / 'transactions_01032021.txt')
+    hint = ('Path to the file with databases connections '
+            'configuration, default: py_scripts/default_dbconf.json')
+    parser.add_argument('--dbconf', type=str, help=hint,
+                        default=default_path / 'py_scripts' /
+                        'default_dbconf.json')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+',
+                        default=[1, 3, 1000],
+                        help='Chunk sizes of the parser, default: 1 3 1000')
+    args = parser.parse_args()
+    with open(args.dbconf) as f:
+        db_conf = json.loads(f.read())
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp, \
+            psycopg2.connect(**db_conf['target']) as conn:
+        path = Path(tmp) / Path(args.file).name
+        valid = write_bad_file(Path(args.file), path)
+        for chunk_size in args.chunk_sizes:
+            rows = loaded_rows(path, chunk_size, conn)
+            failed += rows != valid
+            print(f'chunk size {chunk_size}: {rows} of {valid} valid rows '
+                  f'loaded, {"OK" if rows == valid else "DIFFERENT"}')
+    sys.exit(1 if failed else 0)
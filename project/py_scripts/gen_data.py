@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+"""
+Generator of synthetic datafiles and source schema at configurable scale
+
+Fills tables info.accounts, info.cards and info.clients of the "source"
+database (the tables are created if needed and truncated, use a separate
+database) and writes transactions_DDMMYYYY.txt, terminals_DDMMYYYY.xlsx
+and passport_blacklist_DDMMYYYY.xlsx for every day to the output
+directory. The data has injected fraud of all types: clients with expired
+or blacklisted passports (1), expired accounts (2), transactions of a card
+in different cities within an hour (3) and series of rejected operations
+with decreasing amounts followed by a successful one (4).
+"""
+
+import argparse
+import datetime
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+import psycopg2
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main  # noqa: E402
+
+SOURCE_DDL = '''
+create schema if not exists info;
+create table if not exists info.accounts (
+    account char(20),
+    valid_to date,
+    client varchar(10),
+    create_dt timestamp(0),
+    update_dt timestamp(0)
+);
+create table if not exists info.cards (
+    card_num char(20),
+    account char(20),
+    create_dt timestamp(0),
+    update_dt timestamp(0)
+);
+create table if not exists info.clients (
+    client_id varchar(10),
+    last_name varchar(20),
+    first_name varchar(20),
+    patronymic varchar(20),
+    date_of_birth date,
+    passport_num varchar(15),
+    passport_valid_to date,
+    phone char(16),
+    create_dt timestamp(0),
+    update_dt timestamp(0)
+);
+truncate info.accounts, info.cards, info.clients;
+'''
+LAST_NAMES = ('Иванов', 'Петров', 'Сидоров', 'Смирнов', 'Кузнецов',
+              'Попов', 'Васильев', 'Соколов', 'Михайлов', 'Новиков')
+FIRST_NAMES = ('Иван', 'Петр', 'Сергей', 'Андрей', 'Алексей', 'Дмитрий',
+               'Максим', 'Матвей', 'Егор', 'Артем')
+PATRONYMICS = ('Иванович', 'Петрович', 'Сергеевич', 'Андреевич', None)
+CITIES = ('Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург',
+          'Казань', 'Нижний Новгород', 'Челябинск', 'Самара', 'Омск',
+          'Ростов-на-Дону', 'Уфа', 'Красноярск', 'Воронеж', 'Пермь')
+TERMINAL_TYPES = ('POS', 'ATM', 'ETC')
+# Terminal ids are the type letter and 5 digits
+TERMINALS_CAPACITY = len(TERMINAL_TYPES) * 10 ** 5
+OPER_TYPES = ('PAYMENT', 'WITHDRAW', 'DEPOSIT')
+
+
+def digits(values, width):
+    """Zero padded strings of the integer array"""
+    return pd.Series(values).astype(str).str.zfill(width)
+
+
+def make_source(cards, rng, start):
+    """DataFrames of source tables, every client has one account and
+    every account has one card"""
+    ids = np.arange(cards)
+    old = pd.Timestamp('1900-01-01')
+    clients = pd.DataFrame({
+        'client_id': (ids + 1).astype(str),
+        'last_name': rng.choice(LAST_NAMES, cards),
+        'first_name': rng.choice(FIRST_NAMES, cards),
+        'patronymic': rng.choice(np.array(PATRONYMICS, dtype=object), cards),
+        'date_of_birth': pd.Timestamp('1950-01-01')
+        + pd.to_timedelta(rng.integers(0, 18000, cards), unit='D'),
+        'passport_num': digits(1000 + ids // 1000000, 4) + ' '
+        + digits(ids % 1000000, 6),
+        'passport_valid_to': pd.Timestamp(start)
+        + pd.to_timedelta(rng.integers(200, 7000, cards), unit='D'),
+        'phone': '+7 9' + digits(ids % 100, 2) + ' ' + digits(ids % 1000, 3)
+        + '-' + digits(rng.integers(0, 100, cards), 2) + '-'
+        + digits(rng.integers(0, 100, cards), 2),
+        'create_dt': old,
+        'update_dt': pd.NaT})
+    # Fraud type 1: expired passports, type 2: expired accounts
+    clients.loc[rng.random(cards) < 0.01, 'passport_valid_to'] = \
+        pd.Timestamp(start) - pd.Timedelta(days=30)
+    clients.loc[rng.random(cards) < 0.3, 'passport_valid_to'] = pd.NaT
+    accounts = pd.DataFrame({
+        'account': '40817810' + digits(ids, 12),
+        'valid_to': pd.Timestamp(start)
+        + pd.to_timedelta(rng.integers(100, 2000, cards), unit='D'),
+        'client': clients.client_id,
+        'create_dt': old,
+        'update_dt': pd.NaT})
+    accounts.loc[rng.random(cards) < 0.01, 'valid_to'] = \
+        pd.Timestamp(start) - pd.Timedelta(days=10)
+    numbers = digits(4000000000000000 + ids * 7919, 16)
+    card_df = pd.DataFrame({
+        'card_num': numbers.str[:4] + ' ' + numbers.str[4:8] + ' '
+        + numbers.str[8:12] + ' ' + numbers.str[12:],
+        'account': accounts.account,
+        'create_dt': old,
+        'update_dt': pd.NaT})
+    return clients, accounts, card_df
+
+
+def write_source(clients, accounts, cards, conn):
+    with conn.cursor() as cursor:
+        cursor.execute(SOURCE_DDL)
+        for table, df in (('clients', clients), ('accounts', accounts),
+                          ('cards', cards)):
+            main.write_rows(cursor, f'info.{table}', tuple(df.columns), df)
+    conn.commit()
+
+
+def make_terminals(count, rng):
+    """Terminals evenly split between the types, ids are numbered within
+    the type to fit varchar(6), so count is up to TERMINALS_CAPACITY"""
+    ids = rng.permutation(count)
+    types = np.array(TERMINAL_TYPES)[ids % len(TERMINAL_TYPES)]
+    return pd.DataFrame({
+        'terminal_id': pd.Series(types).str[0]
+        + digits(ids // len(TERMINAL_TYPES), 5),
+        'terminal_type': types,
+        'terminal_city': rng.choice(CITIES, count),
+        'terminal_address': 'ул. ' + pd.Series(rng.choice(LAST_NAMES, count))
+        + 'а, д. ' + pd.Series(rng.integers(1, 200, count)).astype(str)})
+
+
+def change_terminals(df, rng, share=0.001):
+    """Next day snapshot: changed addresses, removed and new terminals"""
+    df = df.copy()
+    n = max(1, int(df.shape[0] * share))
+    changed = rng.choice(df.shape[0], n, replace=False)
+    df.loc[df.index[changed], 'terminal_address'] = \
+        'пр. ' + pd.Series(rng.integers(1, 200, n)).astype(str).values
+    df = df.drop(df.index[rng.choice(df.shape[0], n, replace=False)])
+    new = make_terminals(n, rng)
+    new['terminal_id'] = 'N' + digits(rng.integers(0, 10 ** 5, n), 5).values
+    new = new[~new.terminal_id.isin(df.terminal_id)]
+    return pd.concat([df, new], ignore_index=True)
+
+
+def write_xlsx(df, path):
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet()
+    sheet.append(list(df.columns))
+    for row in df.itertuples(index=False, name=None):
+        sheet.append([None if pd.isna(x) else x for x in row])
+    book.save(path)
+
+
+def fraud_series(cards, terminals, rng, day, amount):
+    """Transactions of the injected fraud types 3 and 4 for the day"""
+    rows = []
+    cities = terminals.groupby('terminal_city').terminal_id.first()
+    for card in rng.choice(cards, amount):
+        # Type 3: two cities within an hour
+        t = day + datetime.timedelta(seconds=int(rng.integers(3600, 82000)))
+        a, b = rng.choice(cities.values, 2, replace=False)
+        rows.append((t, 1000.0, card, 'PAYMENT', 'SUCCESS', a))
+        rows.append((t + datetime.timedelta(minutes=int(rng.integers(5, 50))),
+                     500.0, card, 'WITHDRAW', 'SUCCESS', b))
+    for card in rng.choice(cards, amount):
+        # Type 4: rejected operations with decreasing amounts
+        t = day + datetime.timedelta(seconds=int(rng.integers(3600, 82000)))
+        terminal = cities.values[0]
+        for k, amt in enumerate((9000.0, 7000.0, 5000.0)):
+            rows.append((t + datetime.timedelta(minutes=3 * k), amt, card,
+                         'WITHDRAW', 'REJECT', terminal))
+        rows.append((t + datetime.timedelta(minutes=10), 3000.0, card,
+                     'WITHDRAW', 'SUCCESS', terminal))
+    return pd.DataFrame(rows, columns=main.TRANSACTIONS_COLUMNS[1:])
+
+
+def write_transactions(path, day, number, k, cards, terminals, rng,
+                       fraud, chunk_size):
+    """Write transactions of the day sorted by time in chunks of rows"""
+    extra = fraud_series(cards, terminals, rng, day, fraud) \
+        if fraud else None
+    bounds = np.linspace(0, 86400, max(1, number // chunk_size) + 1) \
+        .astype(int)
+    # Every card is used in the terminals of its home city, so fraud
+    # type 3 comes mostly from the injected series
+    by_city = [x.values for _, x in
+               terminals.groupby('terminal_city').terminal_id]
+    first = 0
+    with open(path, 'w') as f:
+        f.write(';'.join(main.TRANSACTIONS_COLUMNS) + '\n')
+        for begin, end in zip(bounds[:-1], bounds[1:]):
+            n = int(number * (end - begin) / 86400)
+            card = rng.integers(0, len(cards), n)
+            home = card % len(by_city)
+            terminal = np.empty(n, dtype=object)
+            for i, ids in enumerate(by_city):
+                terminal[home == i] = rng.choice(ids, (home == i).sum())
+            df = pd.DataFrame({
+                'transaction_date': pd.Timestamp(day) + pd.to_timedelta(
+                    rng.integers(begin, end, n), unit='s'),
+                'amount': rng.integers(1000, 10 ** 6, n) / 100,
+                'card_num': cards[card],
+                'oper_type': rng.choice(OPER_TYPES, n),
+                'oper_result': np.where(rng.random(n) < 0.9, 'SUCCESS',
+                                        'REJECT'),
+                'terminal': terminal})
+            if extra is not None:
+                seconds = (extra.transaction_date - pd.Timestamp(day)) \
+                    .dt.total_seconds()
+                df = pd.concat([df, extra[(seconds >= begin)
+                                          & (seconds < end)]])
+            df = df.sort_values('transaction_date', kind='stable')
+            df.insert(0, 'transaction_id',
+                      [f'{k:03d}{first + i:08d}' for i in range(df.shape[0])])
+            first += df.shape[0]
+            df.to_csv(f, sep=';', decimal=',', float_format='%.2f',
+                      header=False, index=False,
+                      date_format='%Y-%m-%d %H:%M:%S')
+    return first
+
+
+if __name__ == "__main__":
+    default_path = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    hint = ('Path to the file with databases connections configuration '
+            '(required unless --no-source), the tables of its "source" '
+            'database are truncated, so it must not be the real source')
+    parser.add_argument('--dbconf', type=str, help=hint)
+    parser.add_argument('--outdir', type=str, required=True,
+                        help='Directory for the generated datafiles')
+    parser.add_argument('--start', type=str, default='2021-03-01',
+                        help='First day (YYYY-MM-DD), default: 2021-03-01')
+    parser.add_argument('--days', type=int, default=3,
+                        help='Amount of days, default: 3')
+    parser.add_argument('--transactions', type=int, default=100000,
+                        help='Amount of transactions per day')
+    parser.add_argument('--cards', type=int, default=50000,
+                        help='Amount of cards (and accounts and clients)')
+    parser.add_argument('--terminals', type=int, default=10000,
+                        help='Amount of terminals, up to '
+                        f'{TERMINALS_CAPACITY}')
+    parser.add_argument('--fraud', type=int, default=100,
+                        help='Amount of injected series of types 3 and 4 '
+                        'per day, the blacklist gets the same amount of '
+                        'passports per day')
+    parser.add_argument('--chunk-size', type=int,
+                        default=main.DEFAULT_CHUNK_SIZE * 10,
+                        help='Amount of transactions generated at once')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--no-source', action='store_true',
+                        help='Do not fill the source tables')
+    args = parser.parse_args()
+    if args.dbconf is None and not args.no_source:
+        parser.error('--dbconf with a separate source database is required '
+                     'to fill the source tables (or use --no-source)')
+    if not 0 < args.terminals <= TERMINALS_CAPACITY:
+        parser.error(f'--terminals must be 1-{TERMINALS_CAPACITY}, '
+                     'terminal ids are limited to varchar(6)')
+    rng = np.random.default_rng(args.seed)
+    start = datetime.datetime.strptime(args.start, '%Y-%m-%d')
+    out = Path(args.outdir)
+    out.mkdir(parents=True, exist_ok=True)
+    clients, accounts, cards = make_source(args.cards, rng, start)
+    if not args.no_source:
+        with open(args.dbconf) as f:
+            db_conf = json.loads(f.read())
+        with psycopg2.connect(**db_conf['source']) as conn:
+            write_source(clients, accounts, cards, conn)
+        print(f'Source tables: {args.cards} clients, accounts and cards')
+    terminals = make_terminals(args.terminals, rng)
+    blacklist = pd.DataFrame(columns=['date', 'passport'])
+    for k in range(args.days):
+        day = start + datetime.timedelta(days=k)
+        tag = day.strftime('%d%m%Y')
+        if k > 0:
+            terminals = change_terminals(terminals, rng)
+        write_xlsx(terminals, out / f'terminals_{tag}.xlsx')
+        # The blacklist file is cumulative
+        added = pd.DataFrame({
+            'date': day,
+            'passport': rng.choice(clients.passport_num.values, args.fraud)})
+        blacklist = pd.concat([blacklist, added], ignore_index=True)
+        write_xlsx(blacklist, out / f'passport_blacklist_{tag}.xlsx')
+        rows = write_transactions(out / f'transactions_{tag}.txt', day,
+                                  args.transactions, k,
+                                  cards.card_num.values, terminals, rng,
+                                  args.fraud, args.chunk_size)
+        print(f'{day.date()}: {rows} transactions, '
+              f'{terminals.shape[0]} terminals, '
+              f'{blacklist.shape[0]} blacklisted passports')
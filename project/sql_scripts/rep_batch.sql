@@ -0,0 +1,36 @@
+-- Set-based version of rep.sql: all dates of the queue de10.rdkv_stg_rep_fraud_loads
+-- in one pass, the report date is the date of transaction instead of a parameter
+-- (parameters first_dt and last_dt are the bounds of the queue for pruning partitions)
+-- Fill de10.rdkv_stg_rep_fraud_tmp before the script: rep_batch_tmp.sql or
+-- function enrich_transactions (enrich engine "python")
+
+-- Statistics of the queue (the enrich engine "python" does not analyze it)
+-- and of the filled temporary table for the joins
+analyze de10.rdkv_stg_rep_fraud_loads;
+analyze de10.rdkv_stg_rep_fraud_tmp;
+
+-- Add data for the 1st fraud type
+insert into de10.rdkv_rep_fraud(event_dt, passport, fio, phone, event_type, report_dt)
+select tmp.event_dt,
+    tmp.passport,
+    tmp.fio,
+    tmp.phone,
+    1,
+    tmp.load_dt
+from de10.rdkv_stg_rep_fraud_tmp tmp 
+left join de10.rdkv_dwh_fact_passport_blacklist psp
+    on tmp.passport = psp.passport_num and psp.entry_dt <= tmp.load_dt
+where psp.passport_num is not null
+    or coalesce(tmp.passport_valid_to, tmp.load_dt) < tmp.load_dt;
+
+-- Add data for the 2nd fraud type
+insert into de10.rdkv_rep_fraud(event_dt, passport, fio, phone, event_type, report_dt)
+select event_dt,
+    passport,
+    fio,
+    phone,
+    2,
+    load_dt
+from de10.rdkv_stg_rep_fraud_tmp tmp 
+where coalesce(acc_valid_to, load_dt) < load_dt
+    or acc_deleted_flg = 'Y';
@@ -0,0 +1,15 @@
+-- Set-based version of rep_prev_days.sql for the "cumulative" report mode, runs after
+-- rep_batch.sql and fraud types 3 and 4: every queued date gets the records of the
+-- earlier dates including the ones just built in the same pass
+insert into de10.rdkv_rep_fraud(event_dt, passport, fio, phone, event_type, report_dt)
+select f.event_dt,
+    f.passport,
+    f.fio,
+    f.phone,
+    f.event_type,
+    l.load_dt
+from de10.rdkv_rep_fraud f
+inner join (select distinct load_dt from de10.rdkv_stg_rep_fraud_loads) l
+    on f.report_dt < l.load_dt
+    or f.report_dt not in (select load_dt from de10.rdkv_stg_rep_fraud_loads)
+where f.report_dt = cast(f.event_dt as date);
@@ -0,0 +1,5 @@
+-- Migration of the report to the "incremental" mode:
+-- remove records copied from previous days, the same data is available
+-- in view de10.rdkv_v_rep_fraud
+delete from de10.rdkv_rep_fraud
+where report_dt <> cast(event_dt as date);
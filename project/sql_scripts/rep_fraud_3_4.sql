@@ -0,0 +1,62 @@
+-- Fraud types 3 and 4 for the "sql" report engine, runs after rep.sql
+-- ("python" engine replaces this script with function detect_fraud_3_4)
+
+-- Add data for the 3rd fraud type
+insert into de10.rdkv_rep_fraud(event_dt, passport, fio, phone, event_type, report_dt)
+select event_dt,
+    passport,
+    fio,
+    phone,
+    3,
+    %s 
+from de10.rdkv_stg_rep_fraud_tmp tmp 
+inner join (
+    select t1.trans_id 
+    from de10.rdkv_dwh_fact_tracnsactions t1
+    inner join de10.rdkv_dwh_fact_tracnsactions t2
+        on t1.card_num = t2.card_num
+        and t2.trans_date between t1.trans_date - interval '1 hour' and t1.trans_date
+    inner join de10.rdkv_dwh_dim_terminals_hist term on t2.terminal = term.terminal_id
+        and term.deleted_flg = 'N' and term.effective_to >= t2.trans_date and term.effective_from <= t2.trans_date
+    where t1.trans_date >= cast(%s as timestamp) and t1.trans_date < cast(%s as timestamp) + interval '1 day'
+        -- implied range of t2 for pruning partitions of previous days
+        and t2.trans_date >= cast(%s as timestamp) - interval '1 hour' and t2.trans_date < cast(%s as timestamp) + interval '1 day'
+        and t1.oper_result = 'SUCCESS' and t2.oper_result = 'SUCCESS'
+    group by t1.trans_id
+    having count(distinct term.terminal_city) > 1
+) tp3 on tmp.trans_id = tp3.trans_id;
+
+-- Add data for the 4th fraud type
+insert into de10.rdkv_rep_fraud(event_dt, passport, fio, phone, event_type, report_dt)
+select event_dt,
+    passport,
+    fio,
+    phone,
+    4,
+    %s 
+from de10.rdkv_stg_rep_fraud_tmp tmp 
+inner join ( -- trans_id with 4th type of fraud
+    select trans_id,
+        finish_amt
+    from (
+        select t1.trans_id,
+            t1.amt finish_amt,
+            t2.oper_result,
+            t2.amt,
+            t2.trans_date,
+            coalesce(lag(t2.amt) over (partition by t1.trans_id order by t2.trans_date), t2.amt + 1) prev_amt,
+            row_number() over (partition by t1.trans_id order by t2.trans_date desc) nn,
+            count(*) over (partition by t1.trans_id) cnt
+        from de10.rdkv_dwh_fact_tracnsactions t1
+        inner join de10.rdkv_dwh_fact_tracnsactions t2
+            on t1.card_num = t2.card_num
+            and t2.trans_date between t1.trans_date - interval '20 minutes' and t1.trans_date - interval '1 second'
+        where t1.trans_date >= cast(%s as timestamp) and t1.trans_date < cast(%s as timestamp) + interval '1 day'
+            and t2.trans_date >= cast(%s as timestamp) - interval '20 minutes' and t2.trans_date < cast(%s as timestamp) + interval '1 day'
+            and t1.oper_result = 'SUCCESS'
+    ) t3
+    where cnt >= 3 and nn <= 3
+    group by trans_id, finish_amt
+    having sum(case when oper_result = 'SUCCESS' or prev_amt - amt <= 0 then 1 else 0 end) = 0
+            and min(amt) > finish_amt
+) tp4 on tmp.trans_id = tp4.trans_id;
@@ -0,0 +1,11 @@
+-- Records for previous days for the "cumulative" report mode, runs before rep.sql
+-- ("incremental" mode skips this script, see view de10.rdkv_v_rep_fraud)
+insert into de10.rdkv_rep_fraud(event_dt, passport, fio, phone, event_type, report_dt)
+select event_dt,
+    passport,
+    fio,
+    phone,
+    event_type,
+    %s 
+from de10.rdkv_rep_fraud
+where report_dt = cast(event_dt as date);
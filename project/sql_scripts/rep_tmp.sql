@@ -0,0 +1,34 @@
+-- Enrichment of transactions of the report date with cards, accounts and
+-- clients for rep.sql (enrich engine "sql", runs before it)
+
+-- Clean abd fill temporary table
+delete from de10.rdkv_stg_rep_fraud_tmp;
+insert into de10.rdkv_stg_rep_fraud_tmp (
+	trans_id,
+	event_dt,
+	passport,
+    fio,
+	phone,
+	passport_valid_to,
+	acc_valid_to,
+	acc_deleted_flg,
+	load_dt)
+    select tr.trans_id,
+        tr.trans_date event_dt,
+        cln.passport_num passport,
+        rtrim(concat(cln.last_name, ' ', cln.first_name, ' ', cln.patronymic)) fio,
+        cln.phone,
+        cln.passport_valid_to,
+        acc.valid_to acc_valid_to,
+        acc.deleted_flg acc_deleted_flg,
+        %s load_dt
+    from de10.rdkv_dwh_fact_tracnsactions tr
+    inner join de10.rdkv_dwh_dim_cards_hist card on tr.card_num = card.card_num
+        and card.deleted_flg = 'N' and card.effective_to >= tr.trans_date and card.effective_from <= tr.trans_date
+    inner join de10.rdkv_dwh_dim_accounts_hist acc on card.account_num = acc.account_num
+        and acc.effective_to >= tr.trans_date and acc.effective_from <= tr.trans_date
+    inner join de10.rdkv_dwh_dim_clients_hist cln on acc.client = cln.client_id
+        and cln.deleted_flg = 'N' and cln.effective_to >= tr.trans_date and cln.effective_from <= tr.trans_date
+    -- range condition instead of cast to date for using partitions and indexes
+    where tr.trans_date >= cast(%s as timestamp) and tr.trans_date < cast(%s as timestamp) + interval '1 day'
+        and tr.oper_result = 'SUCCESS';
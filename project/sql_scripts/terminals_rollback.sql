@@ -0,0 +1,13 @@
+-- Roll back terminals SCD2 to the state before the given date for the
+-- conversion of its snapshots again (backfill mode), runs before
+-- terminals_to_scd2.sql for every snapshot in date order
+
+-- Remove versions of the date and the next dates
+delete from de10.rdkv_dwh_dim_terminals_hist
+where effective_from >= to_timestamp(%s, 'YYYY-MM-DD');
+
+-- Open versions closed by the removed ones
+update de10.rdkv_dwh_dim_terminals_hist
+set effective_to = to_timestamp('9999-12-31', 'YYYY-MM-DD')
+where effective_to >= to_timestamp(%s, 'YYYY-MM-DD') - interval '1 second'
+    and effective_to <> to_timestamp('9999-12-31', 'YYYY-MM-DD');
@@ -0,0 +1,44 @@
+-- Delta version of terminals_to_scd2.sql: de10.rdkv_stg_terminals has only new and
+-- changed terminals, de10.rdkv_stg_terminals_del has ids of deleted terminals
+
+-- Insert new and changed rows to target
+insert into de10.rdkv_dwh_dim_terminals_hist(terminal_id, terminal_type, terminal_city, terminal_address, effective_from)
+select terminal_id,
+    terminal_type,
+    terminal_city,
+    terminal_address,
+    to_timestamp(%s, 'YYYY-MM-DD')
+from de10.rdkv_stg_terminals;
+
+--insert deleted rows to target
+insert into de10.rdkv_dwh_dim_terminals_hist(terminal_id, terminal_type, terminal_city, terminal_address, effective_from, deleted_flg)
+select t.terminal_id,
+    t.terminal_type,
+    t.terminal_city,
+    t.terminal_address,
+    to_timestamp(%s, 'YYYY-MM-DD'), 'Y'
+from de10.rdkv_dwh_dim_terminals_hist t
+inner join de10.rdkv_stg_terminals_del d on t.terminal_id = d.terminal_id
+where t.deleted_flg = 'N'
+    and t.effective_to = to_timestamp('9999-12-31', 'YYYY-MM-DD');
+
+--Fix effective_to of the changed terminals only
+update de10.rdkv_dwh_dim_terminals_hist
+set effective_to = t.effective_from - interval '1 second' 
+from de10.rdkv_dwh_dim_terminals_hist t
+where rdkv_dwh_dim_terminals_hist.terminal_id = t.terminal_id
+    and rdkv_dwh_dim_terminals_hist.effective_to = to_timestamp('9999-12-31', 'YYYY-MM-DD')
+    and t.effective_to = to_timestamp('9999-12-31', 'YYYY-MM-DD')
+    and rdkv_dwh_dim_terminals_hist.effective_from < t.effective_from
+    and t.terminal_id in (
+        select terminal_id from de10.rdkv_stg_terminals
+        union all
+        select terminal_id from de10.rdkv_stg_terminals_del);
+
+--Update meta 
+update de10.rdkv_meta_loads
+    set update_dt = to_timestamp(%s, 'YYYY-MM-DD') 
+where schema_name = 'de10' and table_name = 'rdkv_stg_terminals';
+
+--Add date for report bulding in the next step
+insert into de10.rdkv_stg_rep_fraud_loads(load_dt) values(to_date(%s, 'YYYY-MM-DD'));